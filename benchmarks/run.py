@@ -0,0 +1,296 @@
+"""Benchmarks of the preparation, simulation and residual code.
+
+Each benchmark runs on synthetic data (see `synthetic.py`) at several scales,
+from the size of the real datasets up to 100 times as many compositions. Every
+(benchmark, scale) case runs in a fresh subprocess, so that its peak resident
+memory is not inflated by earlier cases, and reports the best and median wall
+time over a few repeats, the time per composition and the peak RSS.
+
+Results are written as JSON to benchmarks/results/<commit>.json, together
+with the package versions, so runs on different commits can be compared:
+
+    python benchmarks/run.py
+    python benchmarks/run.py --isotopologues 10 --out wide.json
+    python benchmarks/run.py --compare benchmarks/results/abc1234.json \
+        benchmarks/results/def5678.json
+
+"""
+
+import argparse
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from collections.abc import Callable
+from dataclasses import replace
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import polars as pl
+from synthetic import DARIA_SIZE, SERGI_SIZE, Size, daria_raw, sergi_raw
+
+from cmfapoc.cache import code_version
+from cmfapoc.data_preparation import prepare_data_daria, prepare_data_sergi
+from cmfapoc.residuals import compositional_residuals, log_ratio_residuals
+from cmfapoc.simulation import simulate
+from cmfapoc.wide import prepare_matrix_sergi
+
+HERE = Path(__file__).parent
+RESULTS_DIR = HERE / "results"
+SCALES = (1, 10, 100)
+REPEATS = 3
+REGRESSION_THRESHOLD = 1.2
+
+
+def _setup_prepare_sergi(size: Size) -> Callable[[], Any]:
+    raw = sergi_raw(size)
+    return lambda: prepare_data_sergi(raw, seed=0)
+
+
+def _setup_prepare_sergi_wide(size: Size) -> Callable[[], Any]:
+    raw = sergi_raw(size)
+    return lambda: prepare_matrix_sergi(raw, seed=0)
+
+
+def _setup_prepare_daria(size: Size) -> Callable[[], Any]:
+    raw, natural = daria_raw(size)
+    empty = raw.clear()
+    return lambda: prepare_data_daria(raw, empty, natural)
+
+
+def _setup_simulate(transformation: str) -> Callable[[Size], Callable]:
+    def setup(size: Size) -> Callable[[], Any]:
+        raw = sergi_raw(size)
+        dataset = prepare_data_sergi(raw, seed=0)
+        return lambda: simulate(dataset, 0.1, transformation, seed=0)
+
+    return setup
+
+
+def _setup_residuals(transformation: str) -> Callable[[Size], Callable]:
+    def setup(size: Size) -> Callable[[], Any]:
+        raw, natural = daria_raw(size, missing=0.0)
+        prepared = prepare_data_daria(raw, raw.clear(), natural)
+        return lambda: log_ratio_residuals(prepared, transformation)
+
+    return setup
+
+
+def _setup_residuals_all(size: Size) -> Callable[[], Any]:
+    raw, natural = daria_raw(size, missing=0.0)
+    prepared = prepare_data_daria(raw, raw.clear(), natural)
+    return lambda: compositional_residuals(prepared)
+
+
+BENCHMARKS: dict[str, tuple[Size, Callable[[Size], Callable[[], Any]]]] = {
+    "prepare_sergi": (SERGI_SIZE, _setup_prepare_sergi),
+    "prepare_sergi_wide": (SERGI_SIZE, _setup_prepare_sergi_wide),
+    "prepare_daria": (DARIA_SIZE, _setup_prepare_daria),
+    **{
+        f"simulate_{t}": (SERGI_SIZE, _setup_simulate(t))
+        for t in ("alr", "clr", "ilr")
+    },
+    **{
+        f"residuals_{t}": (DARIA_SIZE, _setup_residuals(t))
+        for t in ("alr", "clr", "ilr")
+    },
+    "residuals_all": (DARIA_SIZE, _setup_residuals_all),
+}
+
+
+def _peak_rss_mb() -> float:
+    """Peak resident memory of this process so far, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere.
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def run_case(
+    name: str,
+    scale: int,
+    repeats: int = REPEATS,
+    isotopologues: int | None = None,
+) -> dict:
+    """Run one benchmark at one scale in this process."""
+    base_size, setup = BENCHMARKS[name]
+    if isotopologues is not None:
+        base_size = replace(base_size, n_isotopologues=isotopologues)
+    size = base_size.scaled(scale)
+    fn = setup(size)
+    setup_rss = _peak_rss_mb()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    median = statistics.median(times)
+    return {
+        "benchmark": name,
+        "scale": scale,
+        "n_samples": size.n_samples,
+        "n_metabolites": size.n_metabolites,
+        "n_isotopologues": size.n_isotopologues,
+        "n_compositions": size.n_compositions,
+        "repeats": repeats,
+        "best_s": min(times),
+        "median_s": median,
+        "us_per_composition": 1e6 * median / size.n_compositions,
+        "setup_peak_rss_mb": setup_rss,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _run_in_subprocess(
+    name: str,
+    scale: int,
+    repeats: int,
+    isotopologues: int | None,
+) -> dict:
+    args = [sys.executable, __file__, "--case", name, str(scale)]
+    args += ["--repeats", str(repeats)]
+    if isotopologues is not None:
+        args += ["--isotopologues", str(isotopologues)]
+    out = subprocess.run(args, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.splitlines()[-1])
+
+
+def _git_commit() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=HERE,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return out.stdout.strip()
+
+
+def run_all(
+    names: list[str],
+    scales: list[int],
+    repeats: int = REPEATS,
+    out: Path | None = None,
+    isotopologues: int | None = None,
+) -> Path:
+    """Run benchmarks in subprocesses and write the results to JSON."""
+    commit = _git_commit()
+    results = []
+    for name in names:
+        for scale in scales:
+            result = _run_in_subprocess(name, scale, repeats, isotopologues)
+            print(
+                f"{name:<18} x{scale:<4} {result['median_s']:9.4f}s "
+                f"{result['us_per_composition']:9.2f}us/composition "
+                f"{result['peak_rss_mb']:8.1f}MiB",
+                flush=True,
+            )
+            results.append(result)
+    report = {
+        "commit": commit,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "versions": code_version() | {"numpy": np.__version__},
+        "results": results,
+    }
+    if out is None:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        out = RESULTS_DIR / f"{commit}.json"
+    out.write_text(json.dumps(report, indent=2))
+    return out
+
+
+def compare(
+    old: Path,
+    new: Path,
+    threshold: float = REGRESSION_THRESHOLD,
+) -> pl.DataFrame:
+    """Compare the median times of two result files.
+
+    Returns:
+        One row per case present in both files, with the ratio of the new to
+        the old median time and whether it exceeds `threshold`.
+    """
+    keys = ["benchmark", "scale", "n_isotopologues"]
+    columns = [*keys, "median_s", "peak_rss_mb"]
+
+    def load(path: Path) -> pl.DataFrame:
+        return pl.DataFrame(json.loads(path.read_text())["results"]).select(
+            columns
+        )
+
+    return (
+        load(old)
+        .join(load(new), on=keys, suffix="_new")
+        .with_columns(ratio=pl.col("median_s_new") / pl.col("median_s"))
+        .with_columns(regression=pl.col("ratio") > threshold)
+        .sort(keys)
+    )
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        choices=list(BENCHMARKS),
+        default=list(BENCHMARKS),
+    )
+    parser.add_argument("--scales", nargs="+", type=int, default=SCALES)
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument(
+        "--isotopologues",
+        type=int,
+        help="Isotopologues per metabolite, instead of the real data's.",
+    )
+    parser.add_argument("--out", type=Path, help="Output JSON file.")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        type=Path,
+        metavar=("OLD", "NEW"),
+        help="Compare two result files instead of running benchmarks.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help="Slowdown ratio reported as a regression.",
+    )
+    parser.add_argument(
+        "--case",
+        nargs=2,
+        metavar=("BENCHMARK", "SCALE"),
+        help=argparse.SUPPRESS,
+    )
+    args = parser.parse_args(argv)
+    if args.case is not None:
+        name, scale = args.case
+        result = run_case(name, int(scale), args.repeats, args.isotopologues)
+        print(json.dumps(result))
+        return 0
+    if args.compare is not None:
+        comparison = compare(*args.compare, threshold=args.threshold)
+        with pl.Config(tbl_rows=-1, tbl_cols=-1):
+            print(comparison)
+        return int(comparison["regression"].any())
+    out = run_all(
+        args.benchmarks,
+        args.scales,
+        args.repeats,
+        args.out,
+        args.isotopologues,
+    )
+    print(f"Wrote {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""Synthetic raw data in the formats of Sergi's and Daria's datasets.
+
+Each generator takes a `Size` giving the number of samples, metabolites and
+isotopologues per metabolite, so the benchmarks can grow each dimension
+independently of the others. The default sizes are close to the real data.
+
+"""
+
+from dataclasses import dataclass, replace
+
+import numpy as np
+import polars as pl
+
+MAX_ISOTOPOLOGUES = 10
+
+
+@dataclass(frozen=True)
+class Size:
+    """Dimensions of a synthetic dataset.
+
+    Attributes:
+        n_samples: Number of samples (measurement columns for Sergi's data).
+        n_metabolites: Number of metabolites (species for Sergi's data).
+        n_isotopologues: Number of isotopologues of each metabolite.
+    """
+
+    n_samples: int
+    n_metabolites: int
+    n_isotopologues: int
+
+    @property
+    def n_compositions(self) -> int:
+        return self.n_samples * self.n_metabolites
+
+    def scaled(self, factor: int) -> "Size":
+        """Grow the number of compositions by `factor`.
+
+        The number of samples grows first, by up to 10 times, and the number
+        of metabolites grows by the rest of the factor.
+        """
+        sample_factor = min(factor, 10)
+        metabolite_factor = max(factor // sample_factor, 1)
+        return replace(
+            self,
+            n_samples=self.n_samples * sample_factor,
+            n_metabolites=self.n_metabolites * metabolite_factor,
+        )
+
+
+SERGI_SIZE = Size(n_samples=52, n_metabolites=28, n_isotopologues=5)
+DARIA_SIZE = Size(n_samples=18, n_metabolites=18, n_isotopologues=5)
+
+
+def _fractions(
+    rng: np.random.Generator,
+    n_compositions: int,
+    n_isotopologues: int,
+) -> np.ndarray:
+    """Random compositions shaped like natural isotopologue distributions."""
+    weights = 0.1 ** np.arange(n_isotopologues)
+    x = rng.gamma(shape=20 * weights, size=(n_compositions, n_isotopologues))
+    return x / x.sum(axis=1, keepdims=True)
+
+
+def sergi_raw(size: Size = SERGI_SIZE, seed: int = 0) -> pl.DataFrame:
+    """Raw data in the pivot-table format of Sergi's dataset.
+
+    Args:
+        size: Dimensions of the dataset. Each sample is split into two
+            replicate columns.
+        seed: Seed for the random measurements.
+
+    Returns:
+        A dataframe with the columns of "PivotTable_freqs 1.csv".
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = size.n_metabolites * size.n_isotopologues
+    species = np.repeat(
+        [f"S{m}_{100 + m}" for m in range(size.n_metabolites)],
+        size.n_isotopologues,
+    )
+    isotopologue = [
+        f"S{m}_{100 + m + i}"
+        for m in range(size.n_metabolites)
+        for i in range(size.n_isotopologues)
+    ]
+    columns = [
+        f"ID_{2 * s}_rep_{r}"
+        for s in range(size.n_samples // 2)
+        for r in (1, 2)
+    ]
+    intensity = _fractions(
+        rng, size.n_metabolites * len(columns), size.n_isotopologues
+    )
+    intensity = intensity.reshape(size.n_metabolites, len(columns), -1)
+    intensity = intensity.transpose(0, 2, 1).reshape(n_rows, len(columns))
+    meta = {
+        "RT": rng.uniform(100, 500, (n_rows, len(columns))),
+        "absolute_difference": rng.uniform(0, 0.05, (n_rows, len(columns))),
+        "peak_apex_int": intensity,
+    }
+    return pl.concat(
+        pl.DataFrame(
+            {
+                "component_name": isotopologue,
+                "component_group_name": species,
+                "meta_value": [meta_value] * n_rows,
+            }
+        ).hstack(pl.DataFrame(values, schema=columns, orient="row"))
+        for meta_value, values in meta.items()
+    )
+
+
+def daria_raw(
+    size: Size = DARIA_SIZE,
+    seed: int = 0,
+    missing: float = 0.05,
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """Raw instrument export and natural fractions like Daria's dataset.
+
+    Args:
+        size: Dimensions of the dataset. At most MAX_ISOTOPOLOGUES
+            isotopologues are supported, as the preparation reads a single
+            digit from each component name.
+        seed: Seed for the random measurements.
+        missing: Fraction of heights that are "N/A".
+
+    Returns:
+        A tuple (raw, natural) with the columns of the raw exports and of
+        "theoretical.csv".
+    """
+    if size.n_isotopologues > MAX_ISOTOPOLOGUES:
+        msg = f"At most {MAX_ISOTOPOLOGUES} isotopologues are supported."
+        raise ValueError(msg)
+    rng = np.random.default_rng(seed)
+    metabolites = [f"met{m}" for m in range(size.n_metabolites)]
+    isotopologues = [f"m{i}" for i in range(size.n_isotopologues)]
+    samples = [f"HEK_Wt_QC{s}_1x_split1_inj1" for s in range(size.n_samples)]
+    natural = _fractions(rng, size.n_metabolites, size.n_isotopologues)
+    natural_df = pl.DataFrame(
+        {
+            "ID": [f"{m}_{i}" for m in metabolites for i in isotopologues],
+            "Theoretical": 100 * natural.ravel(),
+        }
+    )
+    total = rng.lognormal(12, 1, size=(size.n_samples, size.n_metabolites, 1))
+    noise = rng.lognormal(0, 0.1, size=total.shape[:2] + natural.shape[1:])
+    height = (total * natural[None] * noise).ravel()
+    height_str = np.where(
+        rng.random(height.shape) < missing, "N/A", height.astype(str)
+    )
+    n_per_sample = size.n_metabolites * size.n_isotopologues
+    raw = pl.DataFrame(
+        {
+            "Sample Name": np.repeat(samples, n_per_sample),
+            "Component Name": [
+                f"{m}_{i}-0" for m in metabolites for i in isotopologues
+            ]
+            * size.n_samples,
+            "Component Group Name": np.repeat(
+                metabolites, size.n_isotopologues
+            ).tolist()
+            * size.n_samples,
+            "Height": height_str,
+        }
+    )
+    return raw, natural_df
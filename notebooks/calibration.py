@@ -44,39 +44,29 @@ def _():
     import polars as pl
 
     from matplotlib import pyplot as plt
-    from numpy.typing import NDArray
-    from skbio.stats.composition import clr, clr_inv, ilr, ilr_inv, alr, alr_inv, sbp_basis
 
-    from cmfapoc.data_preparation import close
+    from cmfapoc.data_preparation import load_prepared
+    from cmfapoc.residuals import compositional_residuals
 
     plt.rcParams['axes.prop_cycle'] = cycler('color', plt.get_cmap('tab10').colors)
 
     return (
-        NDArray,
         Path,
-        alr,
-        alr_inv,
-        close,
-        clr,
-        clr_inv,
+        compositional_residuals,
         cycler,
-        ilr,
-        ilr_inv,
+        load_prepared,
         mo,
         np,
         pl,
         plt,
-        sbp_basis,
     )
 
 
 @app.cell
-def _(Path, __file__, pl):
-    DATA_FILE = Path(__file__).parent.parent / "data" / "prepared" / "measurements-daria.csv"
-
-    measurements = pl.read_csv(DATA_FILE)
+def _(load_prepared):
+    measurements = load_prepared("daria")
     measurements
-    return DATA_FILE, measurements
+    return (measurements,)
 
 
 @app.cell
@@ -134,26 +124,24 @@ def _(mo):
         r"""
         ## Quick exploration 
 
-        To get a quick idea about the agreement between  we can start by just dropping all the null rows and re-closing the measurement columns.
+        To get a quick idea about the agreement between  we can start by just dropping all the null rows. `compositional_residuals` then re-closes the remaining measurements and natural fractions of each set and computes the residuals of every transformation used below in one pass, as one table.
         """
     )
     return
 
 
 @app.cell
-def _(close, measurements, pl):
+def _(compositional_residuals, measurements, pl):
     msts_no_zeros = (
         measurements
         .filter(
             (pl.col("measurement").is_not_null())
             & (pl.col("metabolite") != "akg")
             & (pl.col("measurement").count().over("sample", "metabolite") > 1))
-        .with_columns(
-            natural_fraction=close(pl.col("natural_fraction"), over=("sample", "metabolite")),
-            measured_fraction=close(pl.col("measurement"), over=("sample", "metabolite")),
-        )
     )
-    return (msts_no_zeros,)
+    residuals = compositional_residuals(msts_no_zeros)
+    residuals
+    return msts_no_zeros, residuals
 
 
 @app.cell
@@ -183,38 +171,10 @@ def _(mo):
 
 
 @app.cell
-def _(clr, msts_no_zeros, pl):
-    def func_clr(subdf: pl.DataFrame) -> pl.DataFrame:
-        subdf = subdf.sort("isotopologue")
-        row0 = subdf.row(0, named=True)
-        met = row0["metabolite"]
-        sample = row0["sample"]
-        total_mst = subdf["measurement"]
-        ratio = [f"m{i}:gmean" for i in range(len(subdf))]
-        m = clr(subdf["measurement"])
-        nf = clr(subdf["natural_fraction"])
-        resid = m - nf
-        return pl.DataFrame(
-            {
-                "metabolite": met,
-                "sample": sample,
-                "ratio": ratio,
-                "m": m,
-                "nf": nf,
-                "resid": resid,
-                "total_measurement": total_mst,
-            }
-        )
-
-
-
-    msts_no_zeros_clr = (
-        msts_no_zeros
-        .group_by("sample", "metabolite", maintain_order=True)
-        .map_groups(func_clr)
-    )
+def _(residuals):
+    msts_no_zeros_clr = residuals.filter(transformation="clr")
     msts_no_zeros_clr.filter(metabolite="fdp", sample="HEK_Wt_QC1_1x_split1_inj1")
-    return func_clr, msts_no_zeros_clr
+    return (msts_no_zeros_clr,)
 
 
 @app.cell
@@ -247,36 +207,10 @@ def _(mo):
 
 
 @app.cell
-def _(alr, msts_no_zeros, pl):
-    def func_alr(subdf: pl.DataFrame) -> pl.DataFrame:
-        subdf = subdf.sort("isotopologue")
-        row0 = subdf.row(0, named=True)
-        met = row0["metabolite"]
-        sample = row0["sample"]
-        total_mst = row0["measurement"] + subdf["measurement"].tail(len(subdf)-1)
-        ratio = [f"m{i+1}:m0" for i in range(len(subdf)-1)]
-        m = alr(subdf["measurement"], denominator_idx=0)
-        nf = alr(subdf["natural_fraction"], denominator_idx=0)
-        resid = m - nf
-        return pl.DataFrame(
-            {
-                "metabolite": met,
-                "sample": sample,
-                "ratio": ratio,
-                "m": m,
-                "nf": nf,
-                "resid": resid,
-                "total_measurement": total_mst,
-            }
-        )
-
-    msts_no_zeros_alr = (
-        msts_no_zeros
-        .group_by("sample", "metabolite", maintain_order=True)
-        .map_groups(func_alr)
-    )
+def _(residuals):
+    msts_no_zeros_alr = residuals.filter(transformation="alr")
     msts_no_zeros_alr
-    return func_alr, msts_no_zeros_alr
+    return (msts_no_zeros_alr,)
 
 
 @app.cell
@@ -301,47 +235,10 @@ def _(mo):
 
 
 @app.cell
-def _(NDArray, ilr, msts_no_zeros, np, pl, sbp_basis):
-    def get_orthonormal_basis_and_labels(size: int) -> tuple[NDArray, list[str]]:
-        if size < 2:
-            raise ValueError("size must be greater than 1")
-        out = np.zeros((size-1, size))
-        labels = [f"m{i+1}+:m{i}" for i in range(size-1)]
-        for row_ix in range(size-1):
-            out[row_ix, row_ix] = -1
-            out[row_ix, row_ix+1:] = 1
-        return sbp_basis(out), labels
-
-
-    def func_ilr(subdf: pl.DataFrame) -> pl.DataFrame:
-        subdf = subdf.sort("isotopologue")
-        row0 = subdf.row(0, named=True)
-        met = row0["metabolite"]
-        sample = row0["sample"]
-        total_mst = subdf["measurement"].cum_sum(reverse=True).head(len(subdf)-1)
-        basis, ratios = get_orthonormal_basis_and_labels(len(subdf))
-        m = ilr(subdf["measurement"], basis=basis)
-        nf = ilr(subdf["natural_fraction"], basis=basis)
-        resid = m - nf
-        return pl.DataFrame(
-            {
-                "metabolite": met,
-                "sample": sample,
-                "ratio": ratios,
-                "m": m,
-                "nf": nf,
-                "resid": resid,
-                "total_measurement": total_mst,
-            }
-        )
-
-    msts_no_zeros_ilr = (
-        msts_no_zeros
-        .group_by("sample", "metabolite", maintain_order=True)
-        .map_groups(func_ilr)
-    )
+def _(residuals):
+    msts_no_zeros_ilr = residuals.filter(transformation="ilr")
     msts_no_zeros_ilr
-    return func_ilr, get_orthonormal_basis_and_labels, msts_no_zeros_ilr
+    return (msts_no_zeros_ilr,)
 
 
 @app.cell
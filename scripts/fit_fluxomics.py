@@ -1,127 +1,137 @@
-import polars as pl
-import numpy as np
+import argparse
+import logging
 from pathlib import Path
-import cmdstanpy as cmd
-import arviz as az
-import matplotlib.pyplot as plt
+import polars as pl
 
+from cmfapoc.calibration import fit_laplace, screen_runs
+from cmfapoc.data_preparation import NATURAL_FILE, load_prepared
+from cmfapoc.fitting import find_runs, fit_batch, fit_daria
+from cmfapoc.stan_data import POSTERIOR_VARIABLES
+from cmfapoc.stan_models import compiled_model
+from cmfapoc.summaries import (
+    SUMMARY_FILE,
+    read_summaries,
+    save_forest,
+    summarise_inference_data,
+    write_summary,
+)
 
-def main():
-    here = Path(__file__).parent.resolve()
-    root = here.parent
-    data_dir = root / "data/raw"
-    model = cmd.CmdStanModel(stan_file= here / "fluxomics.stan")
-    data_s1 = pl.read_csv(data_dir / "250218_Fluxomics_split1_900uL_g3p_excluded.csv")
-    data_s2 = pl.read_csv(data_dir / "250218_Fluxomics_split2_900uL.csv")
-    data = pl.concat([data_s1,data_s2])
-    theoretical = pl.read_csv(data_dir / "theoretical.csv")
-    undilted_samples = data.filter(pl.col("Sample Name").str.contains("_1x_"))
-    theoretical = theoretical.filter(~pl.col("ID").str.contains_any(["6pgc", "oaa", "g3p"]))
-    undilted_samples = undilted_samples.filter(~pl.col("Component Group Name").str.contains_any(["6pgc", "oaa", "g3p"]))
-    theoretical = theoretical.with_columns(
-        met = pl.col("ID").map_elements(
-            lambda x: x[:-3], return_dtype=pl.String
-        ),
-        parent_group = pl.col("ID").map_elements(
-            lambda x: x.split("_")[-1][1], return_dtype=pl.String
-        ).cast(pl.Int8) + 1,
+MODELS = {
+    "loop": "fluxomics.stan",
+    "vectorized": "fluxomics_vectorized.stan",
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", choices=list(MODELS), default="loop")
+    parser.add_argument("--chains", type=int, default=4)
+    parser.add_argument(
+        "--threads-per-chain",
+        type=int,
+        default=1,
+        help="Threads per chain; more than 1 uses reduce_sum in the vectorized model.",
     )
-    met_group = {met: ix + 1 for ix, met in enumerate(theoretical["met"].unique())}
-    theoretical = theoretical.with_columns(
-        met_group = pl.col("met").replace_strict(met_group),
-        Theoretical = pl.col("Theoretical")/100,
+    parser.add_argument(
+        "--runs",
+        type=Path,
+        help="Directory with one subdirectory of raw files per run to fit in a batch.",
     )
-    undilted_samples = undilted_samples.with_columns(
-        Height = pl.col("Height").cast(
-            pl.Float64, strict=False
-        ),
-        split = pl.col("Sample Name").map_elements(
-            lambda x: x.split("_")[-2], return_dtype=pl.String
-        ),
-        injection = pl.col("Sample Name").map_elements(
-            lambda x: x.split("_")[-1], return_dtype=pl.String
-        ),
-        sample = pl.col("Sample Name").map_elements(
-            lambda x: x.split("_")[2], return_dtype=pl.String
-        ).alias("sample"),
-        parent_group = pl.col("Component Name").map_elements(
-            lambda x: x.split("_")[-1].split("-")[0][1], return_dtype=pl.String
-        ).cast(pl.Int8) + 1
+    parser.add_argument(
+        "--out-dir",
+        type=Path,
+        default=Path("fits"),
+        help="Output directory for batch fits.",
     )
-    undilted_samples = undilted_samples.with_columns(
-        sample_id = pl.concat_str(["split", "injection", "sample"])
+    parser.add_argument(
+        "--natural-file",
+        type=Path,
+        default=NATURAL_FILE,
+        help="Theoretical natural fractions for batch fits.",
     )
-    undilted_samples = undilted_samples.drop_nans("Height")
-    sample_group = {sample: ix + 1 for ix, sample in enumerate(undilted_samples["sample_id"].unique())}
-    undilted_samples = undilted_samples.with_columns(
-        met_group = pl.col("Component Group Name").replace_strict(met_group),
-        sample_group = pl.col("sample_id").replace_strict(sample_group)
+    parser.add_argument(
+        "--cores",
+        type=int,
+        default=None,
+        help="Core budget for batch fits; defaults to all cores.",
     )
-    undilted_samples = undilted_samples.select(["Height", "parent_group", "met_group", "sample_group"])
-    undilted_samples = undilted_samples.group_by(["parent_group", "met_group", "sample_group"]).sum()
-    processed_samples = undilted_samples.join(theoretical, on=["parent_group", "met_group"])
-    processed_samples = processed_samples.with_columns(
-        met_sample = pl.concat_str(
-            [pl.col("met_group"), pl.col("sample_group")],
-            separator="-"
-        )
+    parser.add_argument(
+        "--laplace",
+        action="store_true",
+        help="Fit Daria's data by MAP with a Laplace approximation instead of NUTS.",
     )
-    sample_met_id = processed_samples["met_sample"].unique()
-    sample_met_id_map = {id: ix+1 for ix, id in enumerate(sample_met_id)}
-    processed_samples = processed_samples.with_columns(
-        met_sample_ix = pl.col("met_sample").replace_strict(sample_met_id_map)
+    parser.add_argument(
+        "--screen",
+        action="store_true",
+        help="With --runs, only fit the runs whose Laplace fit fails with NUTS.",
     )
-    stan_input = {
-        "N_meas": processed_samples.shape[0],
-        "N_mets": int(len(met_group)),
-        "N_samples": int(len(sample_group)),
-        "N_met_samples": int(len(sample_met_id_map)),
-        "mets": processed_samples.select(["met_group"]).to_numpy().T[0],
-        "met_samples": processed_samples.select(["met_sample_ix"]).to_numpy().T[0],
-        "p_theoretical": processed_samples.select(["Theoretical"]).to_numpy().T[0],
-        "y": processed_samples.select("Height").to_numpy().T[0],
-    }
-    pf = model.pathfinder(
-        data=stan_input
+    parser.add_argument(
+        "--plot",
+        type=Path,
+        nargs="+",
+        metavar="SUMMARY",
+        help="Only draw the forest plots from saved summaries, comparing runs.",
     )
-    fit = model.sample(
-        data=stan_input,
-        inits=pf.create_inits(),
-        chains=4,
-        iter_warmup=2000,
-        iter_sampling=1000,
-        adapt_delta=0.99,
+    args = parser.parse_args(argv)
+    if args.plot is not None:
+        plot(read_summaries(args.plot))
+        return
+    if args.laplace:
+        fit = fit_laplace(load_prepared("daria"))
+        if not fit.ok:
+            print("The MAP fit did not converge; use NUTS instead.")
+            return
+        print(fit.summary())
+        summarise_and_plot(fit.to_inference_data())
+        return
+    threaded = args.model == "vectorized" and args.threads_per_chain > 1
+    threads_per_chain = args.threads_per_chain if threaded else 1
+    here = Path(__file__).parent.resolve()
+    model = compiled_model(
+        here / MODELS[args.model],
+        cpp_options={"STAN_THREADS": True} if threaded else None,
     )
-    infd = az.from_cmdstanpy(
-        posterior=fit,
-        observed_data={
-            "rescaled_estimated_height": processed_samples.select("Height").to_numpy().T[0]
-        },
-        coords={
-            "met": list(met_group.keys()),
-            "met_sample": list(sample_met_id_map.keys()),
-        },
-        dims={
-            "ln_offset": ["met"],
-            "true_offset": ["met"],
-            "height_T": ["met_sample"],
-        }
+    if args.runs is not None:
+        logging.basicConfig(level=logging.INFO)
+        runs = find_runs(args.runs)
+        if args.screen:
+            screen = screen_runs(runs, args.natural_file)
+            print(screen)
+            flagged = set(screen.filter(~pl.col("ok"))["run"])
+            runs = {k: v for k, v in runs.items() if k in flagged}
+            if not runs:
+                return
+        status = fit_batch(
+            model,
+            runs,
+            args.out_dir,
+            natural_file=args.natural_file,
+            chains=args.chains,
+            threads_per_chain=threads_per_chain,
+            cores=args.cores,
+        )
+        print(status)
+        return
+    infd = fit_daria(
+        model,
+        load_prepared("daria"),
+        chains=args.chains,
+        threads_per_chain=threads_per_chain,
     )
-    fig, ax = plt.subplots(1,1)
-    az.plot_forest(infd, var_names=["ln_offset"], ax=ax)
-    plt.savefig("ln_offsets.png")
-    plt.close()
-    fig, ax = plt.subplots(1,1)
-    az.plot_forest(infd, var_names=["true_offset"], ax=ax)
-    plt.savefig("offsets.png")
-    plt.close()
-    fig, ax = plt.subplots(1,1)
-    az.plot_forest(infd, var_names=["height_T"], ax=ax)
-    ax.set_xscale("log")
-    plt.savefig("height_T.png")
-    fig, ax = plt.subplots(1,1, figsize=(15,15))
-    az.plot_forest(infd, var_names=["rescaled_height_offset"], combined=True, ax=ax)
-    plt.savefig("estimated_height.png")
+    summarise_and_plot(infd)
+
+
+def summarise_and_plot(infd, run="daria"):
+    summary = summarise_inference_data(infd, POSTERIOR_VARIABLES, run=run)
+    write_summary(summary, Path(SUMMARY_FILE))
+    plot(summary)
+
+
+def plot(summary):
+    save_forest(summary, "ln_offset", Path("ln_offsets.png"))
+    save_forest(summary, "true_offset", Path("offsets.png"))
+    save_forest(summary, "height_T", Path("height_T.png"), log_scale=True)
+    save_forest(summary, "rescaled_height_offset", Path("estimated_height.png"))
 
 
 if __name__ == "__main__":
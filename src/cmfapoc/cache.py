@@ -0,0 +1,148 @@
+"""Code for caching tables on disk, keyed by the content of their inputs.
+
+A cached table is an uncompressed Arrow IPC file, which can be memory-mapped
+instead of parsed, next to a JSON manifest recording the hashes of the files it
+was made from and the version of the code that made it. The table is fresh if
+the manifest matches the current inputs and code.
+
+"""
+
+import hashlib
+import json
+from collections.abc import Iterable, Mapping
+from importlib import metadata
+from pathlib import Path
+from typing import Any
+
+import polars as pl
+
+PACKAGE_DIR = Path(__file__).parent
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_hash(path: Path) -> str:
+    """Get the sha256 hex digest of a file's content."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_stat(path: Path) -> list[int]:
+    """Get a file's size and modification time in nanoseconds."""
+    st = path.stat()
+    return [st.st_size, st.st_mtime_ns]
+
+
+def input_hashes(
+    inputs: Iterable[Path],
+    previous: Mapping[str, Any] | None = None,
+) -> tuple[dict[str, str], dict[str, list[int]]]:
+    """Hash each input file once, keyed by its resolved path.
+
+    Args:
+        inputs: Files to hash.
+        previous: An earlier manifest with "inputs" and "stats" entries. The
+            hash it records is reused for a file whose size and modification
+            time are unchanged, instead of reading the file again.
+
+    Returns:
+        The hash and the `file_stat` of each input.
+    """
+    previous = previous or {}
+    old_hashes = previous.get("inputs", {})
+    old_stats = previous.get("stats", {})
+    hashes, stats = {}, {}
+    for p in inputs:
+        key = str(Path(p).resolve())
+        stats[key] = file_stat(Path(p))
+        if key in old_hashes and old_stats.get(key) == stats[key]:
+            hashes[key] = old_hashes[key]
+        else:
+            hashes[key] = file_hash(Path(p))
+    return hashes, stats
+
+
+def code_version() -> dict[str, str]:
+    """Get the versions of the code that prepares data.
+
+    Returns:
+        A dictionary with the installed cmfapoc and polars versions and a
+        hash of the package's source files, which changes with any edit even
+        if the version number does not.
+    """
+    h = hashlib.sha256()
+    for path in sorted(PACKAGE_DIR.glob("*.py")):
+        h.update(path.name.encode())
+        h.update(path.read_bytes())
+    try:
+        version = metadata.version("cmfapoc")
+    except metadata.PackageNotFoundError:
+        version = "unknown"
+    return {
+        "cmfapoc": version,
+        "polars": pl.__version__,
+        "source": h.hexdigest(),
+    }
+
+
+def manifest_path(table_path: Path) -> Path:
+    """Get the path of the manifest belonging to a cached table."""
+    return table_path.with_suffix(".manifest.json")
+
+
+def make_manifest(
+    inputs: Iterable[Path],
+    schema: Mapping[str, pl.DataType],
+    hashes: Mapping[str, str] | None = None,
+) -> dict[str, Any]:
+    """Describe the inputs, code and schema of a cached table.
+
+    Inputs are keyed by their resolved path, so that files with the same name
+    in different directories are told apart. Pass `hashes` from
+    `input_hashes` to avoid hashing the inputs again.
+    """
+    if hashes is None:
+        hashes, _ = input_hashes(inputs)
+    return {
+        "inputs": dict(hashes),
+        "code": code_version(),
+        "schema": {col: str(dtype) for col, dtype in schema.items()},
+    }
+
+
+def is_fresh(table_path: Path, manifest: Mapping[str, Any]) -> bool:
+    """Check whether a cached table exists and matches `manifest`."""
+    path = manifest_path(table_path)
+    if not (table_path.exists() and path.exists()):
+        return False
+    try:
+        written = json.loads(path.read_text())
+    except json.JSONDecodeError:
+        return False
+    return written == manifest
+
+
+def write_table(
+    df: pl.DataFrame,
+    table_path: Path,
+    manifest: Mapping[str, Any],
+) -> None:
+    """Write a cached table and its manifest.
+
+    The manifest is written last, so an interrupted write leaves the table
+    stale rather than apparently fresh. The table is written to a temporary
+    file and then moved into place, so that readers which have memory-mapped
+    the old table keep a valid copy.
+    """
+    manifest_path(table_path).unlink(missing_ok=True)
+    tmp_path = table_path.with_suffix(".tmp")
+    df.write_ipc(tmp_path, compression="uncompressed")
+    tmp_path.replace(table_path)
+    manifest_path(table_path).write_text(json.dumps(manifest, indent=2))
+
+
+def read_table(table_path: Path) -> pl.DataFrame:
+    """Read a cached table, memory-mapping it rather than parsing it."""
+    return pl.scan_ipc(table_path).collect()
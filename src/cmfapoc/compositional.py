@@ -0,0 +1,161 @@
+"""Polars expressions for log-ratio transformations of compositions.
+
+Each function takes an expression for the parts of many compositions in long
+format and the columns identifying each composition (`over`), and returns an
+expression with one value per row, computed with window functions. The
+expressions can be used in eager and lazy queries, including the streaming
+engine, so transformations run inside the query plan.
+
+Transformations with one coordinate fewer than the composition put a zero in
+the row of one part: the reference part for `alr` and the last part for
+`ilr_sequential`. The inverse functions expect the same layout, so that e.g.
+`alr_inv(alr(x, ...), ...)` gives back the closed composition.
+
+Example:
+
+>>> df = pl.DataFrame(
+    {
+        "x": [1.0, 2.0, 3.0, 4.0],
+        "g": ["a", "a", "a", "b"],
+        "i": [0, 1, 2, 0],
+    }
+)
+>>> df.lazy().with_columns(
+    y=ilr_sequential(pl.col("x"), over="g", order_by="i")
+).collect()
+    ┌─────┬─────┬─────┬──────────┐
+    │ x   ┆ g   ┆ i   ┆ y        │
+    │ --- ┆ --- ┆ --- ┆ ---      │
+    │ f64 ┆ str ┆ i64 ┆ f64      │
+    ╞═════╪═════╪═════╪══════════╡
+    │ 1.0 ┆ a   ┆ 0   ┆ 0.731483 │
+    │ 2.0 ┆ a   ┆ 1   ┆ 0.286707 │
+    │ 3.0 ┆ a   ┆ 2   ┆ 0.0      │
+    │ 4.0 ┆ b   ┆ 0   ┆ 0.0      │
+    └─────┴─────┴─────┴──────────┘
+
+"""
+
+from collections.abc import Sequence
+
+import polars as pl
+from polars._typing import IntoExpr
+
+from cmfapoc.data_preparation import close
+
+
+def clr(expr: pl.Expr, over: IntoExpr | Sequence[IntoExpr]) -> pl.Expr:
+    """Centred log ratio of each part.
+
+    Args:
+        expr: Positive parts.
+        over: Columns identifying each composition.
+    """
+    log = expr.log()
+    return log - log.mean().over(over)
+
+
+def clr_inv(expr: pl.Expr, over: IntoExpr | Sequence[IntoExpr]) -> pl.Expr:
+    """Closed composition from centred log ratios.
+
+    Args:
+        expr: Centred log ratios, or any log values defined up to a constant
+            per composition.
+        over: Columns identifying each composition.
+    """
+    return close((expr - expr.max().over(over)).exp(), over=over)
+
+
+def alr(
+    expr: pl.Expr,
+    over: IntoExpr | Sequence[IntoExpr],
+    reference: pl.Expr | None = None,
+    order_by: IntoExpr | Sequence[IntoExpr] | None = None,
+) -> pl.Expr:
+    """Additive log ratio of each part to a reference part.
+
+    Args:
+        expr: Positive parts.
+        over: Columns identifying each composition.
+        reference: Boolean expression that is true for the reference part of
+            each composition, e.g. `pl.col("isotopologue") == "m0"`. If None,
+            the reference is the first part.
+        order_by: Order of the parts, used to find the first part if
+            `reference` is None. If None, the row order is used.
+
+    Returns:
+        An expression that is zero for the reference part, and null for
+        every part of a composition without a reference part.
+    """
+    log = expr.log()
+    if reference is not None:
+        denominator = log.filter(reference).first()
+    elif order_by is not None:
+        denominator = log.sort_by(order_by).first()
+    else:
+        denominator = log.first()
+    return log - denominator.over(over)
+
+
+def alr_inv(expr: pl.Expr, over: IntoExpr | Sequence[IntoExpr]) -> pl.Expr:
+    """Closed composition from additive log ratios.
+
+    Args:
+        expr: Additive log ratios, with zero for the reference part.
+        over: Columns identifying each composition.
+    """
+    return clr_inv(expr, over)
+
+
+def _ilr_counts(
+    expr: pl.Expr,
+    over: IntoExpr | Sequence[IntoExpr],
+    order_by: IntoExpr | Sequence[IntoExpr],
+) -> pl.Expr:
+    """Number of parts after each part, i.e. in the numerator of its balance."""
+    position = pl.int_range(pl.len()).over(over, order_by=order_by)
+    return (expr.len().over(over) - 1 - position).cast(pl.Float64)
+
+
+def ilr_sequential(
+    expr: pl.Expr,
+    over: IntoExpr | Sequence[IntoExpr],
+    order_by: IntoExpr | Sequence[IntoExpr],
+) -> pl.Expr:
+    """Isometric log ratio with the partition m0 | m1+, m1 | m2+, ...
+
+    The coordinate in the row of part i is the balance of all later parts
+    against part i, as in `cmfapoc.residuals`.
+
+    Args:
+        expr: Positive parts.
+        over: Columns identifying each composition.
+        order_by: Order of the parts, e.g. "isotopologue".
+
+    Returns:
+        An expression that is zero for the last part.
+    """
+    log = expr.log()
+    later = log.cum_sum(reverse=True).over(over, order_by=order_by) - log
+    r = _ilr_counts(expr, over, order_by)
+    balance = (r / (r + 1)).sqrt() * (later / r - log)
+    return pl.when(r > 0).then(balance).otherwise(0.0)
+
+
+def ilr_sequential_inv(
+    expr: pl.Expr,
+    over: IntoExpr | Sequence[IntoExpr],
+    order_by: IntoExpr | Sequence[IntoExpr],
+) -> pl.Expr:
+    """Closed composition from `ilr_sequential` coordinates.
+
+    Args:
+        expr: Coordinates, with zero for the last part.
+        over: Columns identifying each composition.
+        order_by: Order of the parts, as passed to `ilr_sequential`.
+    """
+    r = _ilr_counts(expr, over, order_by)
+    scaled = pl.when(r > 0).then(expr / (r * (r + 1)).sqrt()).otherwise(0.0)
+    earlier = scaled.cum_sum().over(over, order_by=order_by) - scaled
+    log = earlier - (r / (r + 1)).sqrt() * expr
+    return clr_inv(log, over)
@@ -0,0 +1,301 @@
+"""Code for fitting the calibration model to one or many datasets.
+
+`fit_daria` fits one prepared dataset. `fit_batch` fits every run in a
+directory, where each run is a subdirectory holding raw instrument exports in
+the same format as Daria's. Each run is fitted in a worker process of its own,
+with as many running at once as keep the chains and threads of all concurrent
+fits within a core budget. The model is compiled once, before any run starts,
+and every worker loads the same executable.
+
+Each run's posterior is written to `<out_dir>/<run>/posterior.nc`, its
+summary to `<out_dir>/<run>/summary.csv` and the quantile summaries of its
+POSTERIOR_VARIABLES (see `cmfapoc.summaries`) to
+`<out_dir>/<run>/posterior_summary.parquet`. A run that fails is recorded in
+the batch's status table and does not stop the other runs.
+
+"""
+
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+from collections.abc import Sequence
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any
+
+import arviz as az
+import cmdstanpy as cmd
+import polars as pl
+
+from cmfapoc.data_preparation import NATURAL_FILE, scan_data_daria
+from cmfapoc.stan_data import POSTERIOR_VARIABLES, stan_input_daria
+from cmfapoc.stan_io import data_file, read_draws
+from cmfapoc.stan_models import (
+    CACHE_DIR,
+    WarmStart,
+    data_fingerprint,
+    load_warm_start,
+    save_warm_start,
+)
+from cmfapoc.summaries import SUMMARY_FILE, summarise_inference_data
+
+SUMMARY_VARIABLES = ["ln_offset", "true_offset", "height_T"]
+
+
+def fit_daria(
+    model: cmd.CmdStanModel,
+    measurements: pl.DataFrame,
+    chains: int = 4,
+    threads_per_chain: int = 1,
+    output_dir: Path | None = None,
+    warm_start: bool = True,
+    variables: Sequence[str] = POSTERIOR_VARIABLES,
+) -> az.InferenceData:
+    """Fit the calibration model to Daria's prepared data.
+
+    The sampler is warm-started from a previous fit of data with the same
+    shape if there is one, and from pathfinder otherwise.
+
+    Args:
+        model: A compiled calibration model. If `threads_per_chain` is more
+            than 1 it must be the vectorized model compiled with STAN_THREADS.
+        measurements: Output of `prepare_data_daria`.
+        chains: Number of chains, all run in parallel.
+        threads_per_chain: Threads used by each chain's likelihood.
+        output_dir: Directory for CmdStan's output files, or None for a
+            temporary directory.
+        warm_start: Whether to start from, and then save, the warm start of
+            data with the same shape. Fits of unrelated data with the same
+            design, such as simulations, should start cold, so that they
+            neither depend on each other nor replace the real data's warm
+            start.
+        variables: Model variables to keep in the posterior.
+
+    Returns:
+        InferenceData with `variables`.
+    """
+    daria_input = stan_input_daria(measurements)
+    threaded = threads_per_chain > 1
+    stan_input = daria_input.data | {"grainsize": 1 if threaded else 0}
+    fingerprint = data_fingerprint(model, stan_input)
+    stan_data_file = data_file(stan_input, CACHE_DIR / "data")
+    start = load_warm_start(fingerprint) if warm_start else None
+    if start is not None:
+        start_kwargs = start.sample_kwargs(chains=chains)
+    else:
+        pf = model.pathfinder(data=stan_data_file, output_dir=output_dir)
+        start_kwargs = {"inits": pf.create_inits(), "iter_warmup": 2000}
+    fit = model.sample(
+        data=stan_data_file,
+        chains=chains,
+        parallel_chains=chains,
+        threads_per_chain=threads_per_chain if threaded else None,
+        iter_sampling=1000,
+        adapt_delta=0.99,
+        output_dir=output_dir,
+        **start_kwargs,
+    )
+    if warm_start:
+        parameters = list(model.src_info()["parameters"])
+        save_warm_start(WarmStart.from_fit(fit, parameters), fingerprint)
+    stats = read_draws(fit.runset.csv_files, ["lp__", "divergent__"])
+    return az.from_dict(
+        posterior=read_draws(fit.runset.csv_files, variables),
+        sample_stats={
+            "lp": stats["lp__"],
+            "diverging": stats["divergent__"].astype(bool),
+        },
+        observed_data={"rescaled_estimated_height": stan_input["y"]},
+        coords=daria_input.coords,
+        dims={
+            "ln_offset": ["met"],
+            "ln_sigma": ["met"],
+            "true_offset": ["met"],
+            "height_T": ["met_sample"],
+        },
+    )
+
+
+def find_runs(runs_dir: Path) -> dict[str, list[Path]]:
+    """Find the raw files of each run in a directory.
+
+    Args:
+        runs_dir: Directory with one subdirectory per run. Every CSV file in a
+            run's subdirectory, except "theoretical.csv", is a raw file.
+
+    Returns:
+        A dictionary mapping run names to their raw files, sorted by name.
+    """
+    runs = {}
+    for run_dir in sorted(p for p in runs_dir.iterdir() if p.is_dir()):
+        raw_files = sorted(
+            p for p in run_dir.glob("*.csv") if p.name != NATURAL_FILE.name
+        )
+        if raw_files:
+            runs[run_dir.name] = raw_files
+    return runs
+
+
+def _fit_run(
+    name: str,
+    raw_files: list[Path],
+    natural_file: Path,
+    stan_file: Path,
+    exe_file: Path,
+    chains: int,
+    threads_per_chain: int,
+    out_dir: Path,
+) -> dict[str, Any]:
+    """Fit one run in a worker process, returning a row of the status table."""
+    start = time.perf_counter()
+    run_dir = out_dir / name
+    row: dict[str, Any] = {"run": name, "status": "ok", "error": None}
+    try:
+        model = cmd.CmdStanModel(stan_file=stan_file, exe_file=exe_file)
+        measurements = scan_data_daria(raw_files, natural_file).collect()
+        run_dir.mkdir(parents=True, exist_ok=True)
+        infd = fit_daria(
+            model,
+            measurements,
+            chains=chains,
+            threads_per_chain=threads_per_chain,
+            output_dir=run_dir / "cmdstan",
+        )
+        infd.to_netcdf(run_dir / "posterior.nc")
+        summary = az.summary(infd, var_names=SUMMARY_VARIABLES)
+        summary.index.name = "variable"
+        summary.to_csv(run_dir / "summary.csv")
+        summarise_inference_data(
+            infd, POSTERIOR_VARIABLES, run=name
+        ).write_parquet(run_dir / SUMMARY_FILE)
+        row["divergences"] = int(infd.sample_stats["diverging"].sum())
+        row["max_r_hat"] = float(summary["r_hat"].max())
+    # One failed run must not stop the rest of the batch.
+    except Exception as e:  # noqa: BLE001
+        row["status"] = "failed"
+        row["error"] = f"{type(e).__name__}: {e}"
+        run_dir.mkdir(parents=True, exist_ok=True)
+        (run_dir / "error.txt").write_text(traceback.format_exc())
+    row["seconds"] = time.perf_counter() - start
+    return row
+
+
+def _fit_run_in_process(*args: Any) -> dict[str, Any]:
+    """Run `_fit_run` in a new process that only this run uses.
+
+    If the process dies, e.g. killed for memory, only this run fails, which
+    would not be the case for a process pool shared by the batch.
+    """
+    # Spawn rather than fork, as forking a process that has used polars can
+    # deadlock.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(_fit_run, *args).result()
+
+
+def fit_batch(
+    model: cmd.CmdStanModel,
+    runs: dict[str, Sequence[Path]],
+    out_dir: Path,
+    natural_file: Path = NATURAL_FILE,
+    chains: int = 4,
+    threads_per_chain: int = 1,
+    cores: int | None = None,
+) -> pl.DataFrame:
+    """Fit the calibration model to many runs concurrently.
+
+    Args:
+        model: A compiled calibration model, shared by all runs.
+        runs: A dictionary mapping run names to their raw files, e.g. the
+            output of `find_runs`.
+        out_dir: Directory for the outputs, with one subdirectory per run.
+        natural_file: CSV file with the theoretical natural fractions.
+        chains: Number of chains per run.
+        threads_per_chain: Threads used by each chain's likelihood.
+        cores: Total number of cores to use, or None for all of them. At most
+            cores // (chains * threads_per_chain) runs are fitted at once.
+
+    Returns:
+        The status table, with one row per run. It is also written to
+        `<out_dir>/runs.csv`, and the summaries of the successful runs are
+        written together to `<out_dir>/summary.csv` and
+        `<out_dir>/posterior_summary.parquet`.
+    """
+    logger = logging.getLogger(__name__)
+    cores_per_fit = chains * threads_per_chain
+    cores = cores or os.cpu_count() or 1
+    if cores_per_fit > cores:
+        msg = (
+            f"One fit needs {cores_per_fit} cores ({chains} chains x "
+            f"{threads_per_chain} threads) but the budget is {cores}."
+        )
+        raise ValueError(msg)
+    max_workers = min(cores // cores_per_fit, max(len(runs), 1))
+    logger.info(f"Fitting {len(runs)} runs, {max_workers} at a time")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rows = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(
+                _fit_run_in_process,
+                name,
+                list(raw_files),
+                natural_file,
+                Path(model.stan_file),
+                Path(model.exe_file),
+                chains,
+                threads_per_chain,
+                out_dir,
+            ): name
+            for name, raw_files in runs.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                row = future.result()
+            except BrokenProcessPool as e:
+                # The worker process itself died, e.g. killed for memory.
+                row = {
+                    "run": name,
+                    "status": "failed",
+                    "error": f"{type(e).__name__}: {e}",
+                }
+            logger.info(
+                f"{name}: {row['status']}"
+                + (f" ({row['error']})" if row["error"] else "")
+            )
+            rows.append(row)
+    status = pl.DataFrame(
+        rows,
+        schema={
+            "run": pl.String,
+            "status": pl.String,
+            "error": pl.String,
+            "divergences": pl.Int64,
+            "max_r_hat": pl.Float64,
+            "seconds": pl.Float64,
+        },
+    ).sort("run")
+    status.write_csv(out_dir / "runs.csv")
+    ok = status.filter(pl.col("status") == "ok")["run"]
+    summaries = [
+        pl.read_csv(out_dir / name / "summary.csv").with_columns(
+            run=pl.lit(name)
+        )
+        for name in ok
+    ]
+    if summaries:
+        pl.concat(summaries).select("run", pl.exclude("run")).write_csv(
+            out_dir / "summary.csv"
+        )
+        pl.concat(
+            pl.read_parquet(out_dir / name / SUMMARY_FILE) for name in ok
+        ).write_parquet(out_dir / SUMMARY_FILE)
+    return status
@@ -0,0 +1,202 @@
+"""Opt-in timing and profiling of pipeline stages.
+
+Wrap a stage in `stage` (or decorate a function with `timed`) to measure its
+wall time, process CPU time, rows in and out and peak resident memory:
+
+>>> with stage("read", file="raw.csv") as record:
+...     df = pl.read_csv("raw.csv")
+...     record.rows_out = len(df)
+
+Measuring is always on and cheap, so callers can use `record.wall_s` in their
+own log messages. After `enable()`, each finished stage is also logged as one
+line of JSON by the "cmfapoc.profiling" logger, and if `enable` is given a
+profile directory, each stage is run under cProfile and its statistics are
+written to `<profile_dir>/<stage>.prof`. `collect` does the same for a
+LazyFrame and also writes its optimized query plan, and per-node timings on
+polars versions that still have `LazyFrame.profile`.
+
+CPU time and peak memory are for the whole process, so they include the work
+of any stages running concurrently in other threads. Peak memory comes from
+the Unix `resource` module and is None on platforms without it. Only one
+stage is run under cProfile at a time; stages that start while another is
+being profiled are timed but not profiled.
+
+"""
+
+import cProfile
+import functools
+import json
+import logging
+import sys
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any
+
+import polars as pl
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+_enabled = False
+_profile_dir: Path | None = None
+_profiler_lock = threading.Lock()
+
+
+@dataclass
+class StageRecord:
+    """Measurements of one run of a stage.
+
+    Attributes:
+        stage: Name of the stage.
+        rows_in: Number of input rows, if known.
+        rows_out: Number of output rows, if known.
+        wall_s: Wall time in seconds.
+        cpu_s: CPU time of the whole process in seconds.
+        peak_rss_mb: Peak resident memory of the process at the end of the
+            stage, in MiB, or None if it cannot be measured.
+        rss_growth_mb: How much the stage raised the peak resident memory,
+            or None if it cannot be measured.
+        fields: Any other values to log with the record.
+    """
+
+    stage: str
+    rows_in: int | None = None
+    rows_out: int | None = None
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    peak_rss_mb: float | None = None
+    rss_growth_mb: float | None = None
+    fields: dict[str, Any] = field(default_factory=dict)
+
+    def to_json(self) -> str:
+        record = asdict(self)
+        return json.dumps(record.pop("fields") | record, default=str)
+
+
+def enable(profile_dir: Path | None = None) -> None:
+    """Log every stage as JSON, and profile stages if `profile_dir` is set."""
+    global _enabled, _profile_dir
+    _enabled = True
+    _profile_dir = profile_dir
+    if profile_dir is not None:
+        profile_dir.mkdir(parents=True, exist_ok=True)
+
+
+def disable() -> None:
+    """Stop logging and profiling stages."""
+    global _enabled, _profile_dir
+    _enabled = False
+    _profile_dir = None
+
+
+def _peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere.
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _file_name(name: str) -> str:
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+
+
+@contextmanager
+def stage(
+    name: str,
+    rows_in: int | None = None,
+    **fields: Any,
+) -> Iterator[StageRecord]:
+    """Measure a pipeline stage.
+
+    Args:
+        name: Name of the stage, also used for its profile files.
+        rows_in: Number of input rows, if known.
+        **fields: Other values to log with the record, e.g. a file name.
+
+    Yields:
+        The stage's record. Set its `rows_out` inside the block; the other
+        measurements are filled in when the block exits.
+    """
+    record = StageRecord(stage=name, rows_in=rows_in, fields=fields)
+    profiler = None
+    if _profile_dir is not None and _profiler_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    rss_start = _peak_rss_mb()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.wall_s = time.perf_counter() - wall_start
+        record.cpu_s = time.process_time() - cpu_start
+        record.peak_rss_mb = _peak_rss_mb()
+        if rss_start is not None:
+            record.rss_growth_mb = record.peak_rss_mb - rss_start
+        if profiler is not None:
+            profiler.disable()
+            _profiler_lock.release()
+            profiler.dump_stats(_profile_dir / f"{_file_name(name)}.prof")
+        if _enabled:
+            logger.info(record.to_json())
+
+
+def timed(name: str | None = None) -> Callable[[Callable], Callable]:
+    """Decorate a function so that each call is measured as a stage.
+
+    If the first argument or the return value is a dataframe, its length is
+    recorded as the rows in or out.
+
+    Args:
+        name: Name of the stage, by default the function's name.
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        stage_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            first = args[0] if args else None
+            rows_in = len(first) if isinstance(first, pl.DataFrame) else None
+            with stage(stage_name, rows_in=rows_in) as record:
+                out = fn(*args, **kwargs)
+                if isinstance(out, pl.DataFrame):
+                    record.rows_out = len(out)
+            return out
+
+        return wrapper
+
+    return decorator
+
+
+def collect(lf: pl.LazyFrame, name: str) -> pl.DataFrame:
+    """Collect a LazyFrame as a stage.
+
+    When profiling, the optimized query plan is written to
+    `<profile_dir>/<name>.plan.txt`, and on polars versions that have
+    `LazyFrame.profile` the per-node timings go to `<name>.polars.csv`.
+    """
+    with stage(name) as record:
+        if _profile_dir is None:
+            df = lf.collect()
+        else:
+            path = _profile_dir / _file_name(name)
+            Path(f"{path}.plan.txt").write_text(lf.explain())
+            try:
+                df, timings = lf.profile()
+            except AttributeError:
+                # LazyFrame.profile was removed in polars 2.0.
+                df = lf.collect()
+            else:
+                timings.write_csv(f"{path}.polars.csv")
+        record.rows_out = len(df)
+    return df
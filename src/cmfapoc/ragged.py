@@ -0,0 +1,278 @@
+"""Log-ratio transformations of many compositions stored in one flat array.
+
+A table of compositional measurements in long format is a ragged array: each
+composition (e.g. one species in one measurement) is a run of consecutive
+values once the rows are sorted by group. This module represents such an array
+as a flat vector of values plus a `Segments` object holding the offset and
+length of each run, so that closure and the alr, clr and ilr transformations
+(and their inverses) can be computed for every composition at once with
+segment sums, means and cumulative sums instead of one Python call per group.
+
+Transformed values are stored in the same layout as the original values. For
+the alr and ilr transformations, which have one coordinate fewer than the
+composition, the first position of each segment is a placeholder that is
+always zero, so that `free_coordinates` selects the coordinates that carry
+information.
+
+The results match scikit-bio's `alr` (with `denominator_idx=0`), `clr` and
+`ilr` (with the default Gram-Schmidt basis) and their inverses.
+
+All functions operate along the last axis, so a block of values with shape
+(..., N) is transformed in one call.
+
+"""
+
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass
+from typing import NamedTuple
+
+import numpy as np
+import polars as pl
+from numpy.typing import NDArray
+from polars._typing import IntoExpr
+
+
+@dataclass(frozen=True)
+class Segments:
+    """Offsets and lengths of consecutive groups in a flat array.
+
+    Attributes:
+        starts: index of the first element of each segment.
+        lengths: number of elements in each segment.
+        group: index of the segment that each element belongs to.
+        position: position of each element within its segment.
+    """
+
+    starts: NDArray[np.intp]
+    lengths: NDArray[np.intp]
+    group: NDArray[np.intp]
+    position: NDArray[np.intp]
+
+    @classmethod
+    def from_lengths(cls, lengths: Sequence[int] | NDArray) -> "Segments":
+        """Create segments from the length of each segment.
+
+        Args:
+            lengths: number of elements in each segment. All must be positive.
+
+        Returns:
+            A Segments object.
+        """
+        lengths = np.asarray(lengths, dtype=np.intp)
+        if (lengths < 1).any():
+            raise ValueError("All segments must have at least one element.")
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        group = np.repeat(np.arange(len(lengths)), lengths)
+        position = np.arange(int(ends[-1]) if len(ends) else 0) - starts[group]
+        return cls(
+            starts=starts, lengths=lengths, group=group, position=position
+        )
+
+    @property
+    def n_segments(self) -> int:
+        return len(self.lengths)
+
+    @property
+    def size(self) -> int:
+        return len(self.group)
+
+
+def group_segments(
+    df: pl.DataFrame,
+    by: IntoExpr | Sequence[IntoExpr],
+) -> tuple[NDArray[np.intp], Segments]:
+    """Find the row order that makes each group of a dataframe contiguous.
+
+    Groups appear in order of first appearance and rows keep their original
+    order within each group, as with `group_by(..., maintain_order=True)`.
+
+    Args:
+        df: A dataframe.
+        by: Columns to group by.
+
+    Returns:
+        A tuple (order, segments), where `order` holds row indexes of `df` such
+        that `df[order]` is sorted by group, and `segments` describes the
+        groups of the sorted rows.
+    """
+    rows = (
+        df.select(by)
+        .with_row_index("__row")
+        .group_by(by, maintain_order=True)
+        .agg(pl.col("__row"))["__row"]
+    )
+    lengths = rows.list.len().to_numpy()
+    order = rows.explode().to_numpy().astype(np.intp)
+    return order, Segments.from_lengths(lengths)
+
+
+def segment_sum(values: NDArray, segments: Segments) -> NDArray:
+    """Sum of each segment, with shape (..., n_segments)."""
+    return np.add.reduceat(values, segments.starts, axis=-1)
+
+
+def segment_mean(values: NDArray, segments: Segments) -> NDArray:
+    """Mean of each segment, with shape (..., n_segments)."""
+    return segment_sum(values, segments) / segments.lengths
+
+
+def segment_max(values: NDArray, segments: Segments) -> NDArray:
+    """Maximum of each segment, with shape (..., n_segments)."""
+    return np.maximum.reduceat(values, segments.starts, axis=-1)
+
+
+def broadcast(per_segment: NDArray, segments: Segments) -> NDArray:
+    """Repeat one value per segment for every element of the segment."""
+    return per_segment[..., segments.group]
+
+
+def segment_cumsum(
+    values: NDArray,
+    segments: Segments,
+    reverse: bool = False,
+) -> NDArray:
+    """Cumulative sum within each segment.
+
+    The values are scattered into a zero-padded (n_segments, max length)
+    block so that sums never run across segment boundaries, which keeps them
+    as accurate as summing each segment separately.
+
+    Args:
+        values: Array with shape (..., N).
+        segments: Segments of the last axis of `values`.
+        reverse: Whether to sum from the end of each segment.
+
+    Returns:
+        An array with the same shape as `values`.
+    """
+    shape = values.shape[:-1] + (
+        segments.n_segments,
+        int(segments.lengths.max()),
+    )
+    padded = np.zeros(shape, dtype=np.result_type(values, float))
+    padded[..., segments.group, segments.position] = values
+    if reverse:
+        padded = np.flip(np.cumsum(np.flip(padded, -1), axis=-1), -1)
+    else:
+        padded = np.cumsum(padded, axis=-1)
+    return padded[..., segments.group, segments.position]
+
+
+def close(values: NDArray, segments: Segments) -> NDArray:
+    """Divide each value by the sum of its segment."""
+    return values / broadcast(segment_sum(values, segments), segments)
+
+
+def multiplicative_replacement(
+    values: NDArray,
+    segments: Segments,
+    delta: float | None = None,
+) -> NDArray:
+    """Close each segment and replace its zeros, keeping it closed.
+
+    Zeros become `delta` and the other parts shrink by the same factor, so
+    that their ratios are unchanged. Segments without zeros are only closed.
+    This matches scikit-bio's `multi_replace`.
+
+    Args:
+        values: Non-negative values.
+        segments: Segments of the last axis of `values`.
+        delta: Replacement value, or None for 1 / length**2 of each segment.
+
+    Returns:
+        An array with the same shape as `values`.
+    """
+    x = close(values, segments)
+    is_zero = x == 0
+    if delta is None:
+        delta = broadcast(1.0 / segments.lengths**2, segments)
+    n_zeros = broadcast(segment_sum(is_zero * 1.0, segments), segments)
+    return np.where(is_zero, delta, x * (1 - n_zeros * delta))
+
+
+def softmax(values: NDArray, segments: Segments) -> NDArray:
+    """Exponentiate and close each segment, i.e. the inverse clr."""
+    shifted = values - broadcast(segment_max(values, segments), segments)
+    return close(np.exp(shifted), segments)
+
+
+def free_coordinates(transformation: str, segments: Segments) -> NDArray:
+    """Boolean mask of the elements holding a coordinate of `transformation`."""
+    if RAGGED_TRANSFORMATIONS[transformation].full_rank:
+        return np.ones(segments.size, dtype=bool)
+    return segments.position > 0
+
+
+def alr(x: NDArray, segments: Segments) -> NDArray:
+    """Additive log ratio with the first element of each segment as reference."""
+    log_x = np.log(x)
+    return log_x - log_x[..., segments.starts][..., segments.group]
+
+
+def alr_inv(z: NDArray, segments: Segments) -> NDArray:
+    """Inverse of `alr`; the reference elements of `z` are ignored."""
+    return softmax(np.where(segments.position > 0, z, 0.0), segments)
+
+
+def clr(x: NDArray, segments: Segments) -> NDArray:
+    """Centred log ratio of each segment."""
+    log_x = np.log(x)
+    return log_x - broadcast(segment_mean(log_x, segments), segments)
+
+
+def clr_inv(z: NDArray, segments: Segments) -> NDArray:
+    """Inverse of `clr`."""
+    return softmax(z, segments)
+
+
+def _ilr_weights(segments: Segments) -> NDArray:
+    i = segments.position
+    return np.sqrt(i / (i + 1))
+
+
+def ilr(x: NDArray, segments: Segments) -> NDArray:
+    """Isometric log ratio with scikit-bio's default Gram-Schmidt basis.
+
+    The coordinate at position i > 0 of a segment is the balance between the
+    first i parts and part i: sqrt(i / (i + 1)) * (mean(log x[:i]) - log x[i]).
+    """
+    log_x = np.log(x)
+    i = segments.position
+    preceding = segment_cumsum(log_x, segments) - log_x
+    with np.errstate(invalid="ignore", divide="ignore"):
+        balance = preceding / i - log_x
+    return np.where(i > 0, _ilr_weights(segments) * balance, 0.0)
+
+
+def ilr_inv(z: NDArray, segments: Segments) -> NDArray:
+    """Inverse of `ilr`; the first element of each segment of `z` is ignored."""
+    i = segments.position
+    c = _ilr_weights(segments)
+    z = np.where(i > 0, z, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        w = np.where(i > 0, z * c / i, 0.0)
+    following = segment_cumsum(w, segments, reverse=True) - w
+    return softmax(following - c * z, segments)
+
+
+class RaggedTransformation(NamedTuple):
+    """A log-ratio transformation of ragged compositions and its inverse.
+
+    Attributes:
+        forward: function mapping compositions to unconstrained coordinates.
+        inverse: function mapping unconstrained coordinates to compositions.
+        full_rank: whether every element holds a coordinate, or whether the
+            first element of each segment is a placeholder.
+    """
+
+    forward: Callable[[NDArray, Segments], NDArray]
+    inverse: Callable[[NDArray, Segments], NDArray]
+    full_rank: bool
+
+
+RAGGED_TRANSFORMATIONS = {
+    "alr": RaggedTransformation(alr, alr_inv, full_rank=False),
+    "clr": RaggedTransformation(clr, clr_inv, full_rank=True),
+    "ilr": RaggedTransformation(ilr, ilr_inv, full_rank=False),
+}
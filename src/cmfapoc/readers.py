@@ -0,0 +1,137 @@
+"""Schema-pinned readers for the raw CSV files.
+
+Each raw file format is declared once as a `CsvFormat`: the columns that are
+used and their dtypes, the strings that mean "missing" and, for the pivot
+table, a pattern for its variable measurement columns. Reading a file
+through its format
+
+- checks the header first, so a renamed or missing column fails at once
+  with the file name rather than deep inside the preparation,
+- reads only the declared columns, with no type inference, so heights are
+  Float64 with "N/A" as null instead of strings cast later, and a value that
+  does not parse as its dtype is an error,
+- scans lazily, so that polars can push projections and filters into its
+  multi-threaded CSV parser.
+
+A UTF-8 byte order mark, as at the start of theoretical.csv, is ignored.
+
+"""
+
+import csv
+import re
+from collections.abc import Mapping, Sequence
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import polars as pl
+
+
+@dataclass(frozen=True)
+class CsvFormat:
+    """A raw CSV format with a pinned schema.
+
+    Attributes:
+        name: Name of the format, e.g. for TOML dataset definitions.
+        columns: The columns to read and their dtypes. All must be in the
+            header.
+        null_values: Strings that are read as null.
+        extra_columns: Regular expression matching further columns to read,
+            e.g. the measurement columns of a pivot table. At least one
+            column must match.
+        extra_dtype: Dtype of the columns matching `extra_columns`.
+    """
+
+    name: str
+    columns: Mapping[str, pl.DataType]
+    null_values: Sequence[str] = field(default_factory=tuple)
+    extra_columns: str | None = None
+    extra_dtype: pl.DataType = field(default_factory=pl.Float64)
+
+    def header(self, path: Path) -> list[str]:
+        """Read the column names of a file, without a byte order mark."""
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            return next(csv.reader(f), [])
+
+    def schema(self, path: Path) -> pl.Schema:
+        """Check a file's header and get the schema of the columns to read.
+
+        Raises:
+            ValueError: If a declared column is missing, or no column
+                matches `extra_columns`.
+        """
+        header = self.header(path)
+        missing = [c for c in self.columns if c not in header]
+        if missing:
+            msg = f"{path.name} is not a {self.name} file: missing {missing}."
+            raise ValueError(msg)
+        schema = dict(self.columns)
+        if self.extra_columns is not None:
+            extra = [c for c in header if re.fullmatch(self.extra_columns, c)]
+            if not extra:
+                msg = (
+                    f"{path.name} is not a {self.name} file: no column "
+                    f"matches {self.extra_columns!r}."
+                )
+                raise ValueError(msg)
+            schema |= {c: self.extra_dtype for c in extra}
+        return pl.Schema(schema)
+
+    def scan(self, paths: Path | Sequence[Path]) -> pl.LazyFrame:
+        """Lazily read one or more files with the same columns.
+
+        The headers of all files are checked before anything is read.
+        """
+        paths = [paths] if isinstance(paths, Path) else list(paths)
+        schemas = [self.schema(p) for p in paths]
+        for path, schema in zip(paths, schemas):
+            if schema != schemas[0]:
+                msg = f"{path.name} has different columns from {paths[0].name}."
+                raise ValueError(msg)
+        return pl.scan_csv(
+            paths,
+            infer_schema=False,
+            schema_overrides=schemas[0],
+            null_values=list(self.null_values) or None,
+        ).select(schemas[0].names())
+
+    def read(self, path: Path) -> pl.DataFrame:
+        """Read a file."""
+        return self.scan(path).collect()
+
+
+DARIA_EXPORT = CsvFormat(
+    name="daria_export",
+    columns={
+        "Height": pl.Float64(),
+        "Sample Name": pl.String(),
+        "Component Name": pl.String(),
+        "Component Group Name": pl.String(),
+    },
+    null_values=("N/A",),
+)
+NATURAL_FRACTIONS = CsvFormat(
+    name="natural_fractions",
+    columns={"ID": pl.String(), "Theoretical": pl.Float64()},
+)
+SERGI_PIVOT = CsvFormat(
+    name="sergi_pivot",
+    columns={
+        "component_name": pl.String(),
+        "component_group_name": pl.String(),
+        "meta_value": pl.String(),
+    },
+    extra_columns=r"ID_\d+_rep_\d+",
+)
+FORMATS = {f.name: f for f in (DARIA_EXPORT, NATURAL_FRACTIONS, SERGI_PIVOT)}
+
+
+def read_raw(path: Path, fmt: CsvFormat | None = None) -> pl.DataFrame:
+    """Read a raw file with its format, or with type inference if it has none.
+
+    Args:
+        path: A CSV file.
+        fmt: The file's format, or None.
+    """
+    if fmt is None:
+        return pl.read_csv(path)
+    return fmt.read(path)
@@ -0,0 +1,266 @@
+"""Log-ratio residuals of measured compositions against expected ones.
+
+For each composition in a long-format table (e.g. each metabolite in each
+sample), `log_ratio_residuals` transforms the measured and expected fractions
+with the alr, clr or ilr transformation and returns their difference, one row
+per log ratio.
+
+Each transformation of a composition with n parts is a fixed linear map of its
+logs, so compositions are bucketed by size and each bucket is transformed with
+one matrix multiplication. The matrices depend only on the transformation and
+the size, and are cached.
+
+The ilr transformation uses the sequential binary partition m0 | m1, m2, ...,
+then m1 | m2, m3, ... and so on, so that ratio "m{i+1}+:m{i}" compares
+isotopologue i with all heavier isotopologues. The alr transformation uses m0
+as the denominator.
+
+`compositional_residuals` computes the closed-fraction residuals and all
+three log-ratio residuals in one pass over the sorted table and returns them
+as one tidy table with a "transformation" column, so that a QC view of every
+residual needs one call:
+
+>>> residuals = compositional_residuals(measurements)
+>>> residuals.filter(transformation="ilr")
+
+"""
+
+import functools
+from collections.abc import Sequence
+
+import numpy as np
+import polars as pl
+from numpy.typing import NDArray
+
+from cmfapoc.ragged import Segments, close
+
+LOG_RATIOS = ("alr", "clr", "ilr")
+BASIS_CACHE_SIZE = 64
+
+
+def _check_log_ratio(transformation: str) -> None:
+    if transformation not in LOG_RATIOS:
+        msg = (
+            f"Unknown transformation {transformation!r}; "
+            f"expected one of {LOG_RATIOS}."
+        )
+        raise ValueError(msg)
+
+
+def sequential_binary_partition(size: int) -> NDArray:
+    """Sign matrix of the partition m0 | m1+, m1 | m2+, ... of `size` parts.
+
+    Args:
+        size: Number of parts, at least 2.
+
+    Returns:
+        An array with shape (size - 1, size), where row i is -1 for part i,
+        +1 for the parts after it and 0 otherwise.
+    """
+    if size < 2:
+        msg = f"size must be greater than 1, got {size}."
+        raise ValueError(msg)
+    out = np.triu(np.ones((size - 1, size)), k=1)
+    out[np.arange(size - 1), np.arange(size - 1)] = -1
+    return out
+
+
+def sbp_basis(partition: NDArray) -> NDArray:
+    """Orthonormal ilr basis of a sequential binary partition, in log space.
+
+    This matches scikit-bio's `sbp_basis`, but returns the contrast matrix
+    that multiplies log values instead of its closed exponential.
+
+    Args:
+        partition: Sign matrix with one row per balance, +1 for the numerator
+            parts, -1 for the denominator parts and 0 for parts not involved.
+
+    Returns:
+        An array with the same shape as `partition`.
+    """
+    r = (partition > 0).sum(axis=1, keepdims=True)
+    s = (partition < 0).sum(axis=1, keepdims=True)
+    plus = np.sqrt(s / (r * (r + s)))
+    minus = np.sqrt(r / (s * (r + s)))
+    return np.where(partition > 0, plus, np.where(partition < 0, -minus, 0.0))
+
+
+@functools.lru_cache(maxsize=BASIS_CACHE_SIZE)
+def log_ratio_basis(transformation: str, size: int) -> NDArray:
+    """Matrix mapping the logs of a composition to its log ratios.
+
+    Args:
+        transformation: One of "alr", "clr" or "ilr".
+        size: Number of parts of the composition.
+
+    Returns:
+        A read-only array with shape (n_ratios, size), where n_ratios is
+        `size` for clr and `size - 1` otherwise.
+    """
+    _check_log_ratio(transformation)
+    if transformation == "clr":
+        out = np.eye(size) - 1 / size
+    elif size < 2:
+        out = np.zeros((0, size))
+    elif transformation == "alr":
+        out = np.eye(size)[1:]
+        out[:, 0] = -1
+    else:
+        out = sbp_basis(sequential_binary_partition(size))
+    out.setflags(write=False)
+    return out
+
+
+@functools.lru_cache(maxsize=BASIS_CACHE_SIZE)
+def total_basis(transformation: str, size: int) -> NDArray:
+    """Matrix summing the parts of a composition that each log ratio uses.
+
+    Args:
+        transformation: One of "alr", "clr" or "ilr".
+        size: Number of parts of the composition.
+
+    Returns:
+        A read-only 0/1 array with the same shape as `log_ratio_basis`. For
+        clr each ratio's total is its own part, for alr it is the part plus
+        m0, and for ilr it is the sum of part i and all heavier parts.
+    """
+    basis = log_ratio_basis(transformation, size)
+    out = np.eye(size) if transformation == "clr" else (basis != 0) * 1.0
+    out.setflags(write=False)
+    return out
+
+
+RATIO_LABELS = {
+    "alr": lambda i: pl.format("m{}:m0", i + 1),
+    "clr": lambda i: pl.format("m{}:gmean", i),
+    "ilr": lambda i: pl.format("m{}+:m{}", i + 1, i),
+}
+RESIDUAL_TRANSFORMATIONS = ("close", *LOG_RATIOS)
+
+
+def compositional_residuals(
+    df: pl.DataFrame,
+    transformations: Sequence[str] = RESIDUAL_TRANSFORMATIONS,
+    observed: str = "measurement",
+    expected: str = "natural_fraction",
+    by: Sequence[str] = ("sample", "metabolite"),
+    order: str = "isotopologue",
+) -> pl.DataFrame:
+    """Closed-fraction and log-ratio residuals of every composition at once.
+
+    The table is sorted into compositions once, and each bucket of
+    compositions of the same size is gathered once and transformed with
+    every requested transformation, so asking for all of them costs little
+    more than asking for one.
+
+    Args:
+        df: Table with one row per part of each composition. Observed and
+            expected values must be positive.
+        transformations: Any of "close", "alr", "clr" and "ilr". "close"
+            compares the closed observed and expected values of each part,
+            and its ratios are labelled by the part's `order` value.
+        observed: Column with the measured values, which need not be closed.
+        expected: Column with the expected values, which need not be closed.
+        by: Columns identifying each composition.
+        order: Column giving the order of the parts within a composition.
+
+    Returns:
+        A dataframe with the `by` columns and columns "transformation",
+        "ratio", "m" (observed value), "nf" (expected value), "resid"
+        (m - nf) and "total_measurement" (sum of the observed values in the
+        ratio). Rows are grouped by transformation, in the order given, with
+        compositions in order of first appearance in `df`.
+    """
+    for transformation in transformations:
+        if transformation != "close":
+            _check_log_ratio(transformation)
+    by = [by] if isinstance(by, str) else list(by)
+    table = (
+        df.with_row_index("__row")
+        .with_columns(__group=pl.col("__row").min().over(by))
+        .sort("__group", order, maintain_order=True)
+    )
+    lengths = table.group_by("__group", maintain_order=True).len()
+    segments = Segments.from_lengths(lengths["len"].to_numpy())
+    values = np.stack([table[observed].to_numpy(), table[expected].to_numpy()])
+    fractions = close(values, segments)
+    log_values = np.log(values)
+    n_ratios = {
+        t: segments.lengths - (t in ("alr", "ilr")) for t in transformations
+    }
+    out_starts = {t: np.cumsum(n) - n for t, n in n_ratios.items()}
+    ratios = {t: np.empty((2, n.sum())) for t, n in n_ratios.items()}
+    totals = {t: np.empty(n.sum()) for t, n in n_ratios.items()}
+    for size in np.unique(segments.lengths):
+        groups = np.flatnonzero(segments.lengths == size)
+        rows = segments.starts[groups, None] + np.arange(size)
+        block, observed_block = log_values[:, rows], values[0, rows]
+        for t in transformations:
+            out_rows = out_starts[t][groups, None] + np.arange(
+                n_ratios[t][groups[0]]
+            )
+            if t == "close":
+                ratios[t][:, out_rows] = fractions[:, rows]
+                totals[t][out_rows] = observed_block
+                continue
+            ratios[t][:, out_rows] = block @ log_ratio_basis(t, int(size)).T
+            totals[t][out_rows] = observed_block @ total_basis(t, int(size)).T
+    keys = table.select(by)
+    out = []
+    for t in transformations:
+        out_group = np.repeat(np.arange(segments.n_segments), n_ratios[t])
+        m, nf = ratios[t]
+        # The parts of a composition may have gaps, e.g. when a missing
+        # isotopologue was filtered out, so each part keeps its own label.
+        ratio = (
+            table[order].cast(pl.String)
+            if t == "close"
+            else RATIO_LABELS[t](pl.col("position"))
+        )
+        out.append(
+            keys[segments.starts[out_group]]
+            .with_columns(
+                position=np.arange(len(out_group)) - out_starts[t][out_group]
+            )
+            .select(
+                *by,
+                transformation=pl.lit(t, dtype=pl.Categorical()),
+                ratio=ratio,
+                m=m,
+                nf=nf,
+                resid=m - nf,
+                total_measurement=totals[t],
+            )
+        )
+    return pl.concat(out)
+
+
+def log_ratio_residuals(
+    df: pl.DataFrame,
+    transformation: str,
+    observed: str = "measurement",
+    expected: str = "natural_fraction",
+    by: Sequence[str] = ("sample", "metabolite"),
+    order: str = "isotopologue",
+) -> pl.DataFrame:
+    """Log-ratio residuals of every composition in a long-format table.
+
+    Args:
+        df: Table with one row per part of each composition. Observed and
+            expected values must be positive.
+        transformation: One of "alr", "clr" or "ilr".
+        observed: Column with the measured values, which need not be closed.
+        expected: Column with the expected values.
+        by: Columns identifying each composition.
+        order: Column giving the order of the parts within a composition.
+
+    Returns:
+        A dataframe with the `by` columns and columns "ratio", "m" (observed
+        log ratio), "nf" (expected log ratio), "resid" (m - nf) and
+        "total_measurement" (sum of the observed values in the ratio).
+        Compositions appear in order of first appearance in `df`.
+    """
+    _check_log_ratio(transformation)
+    return compositional_residuals(
+        df, (transformation,), observed, expected, by, order
+    ).drop("transformation")
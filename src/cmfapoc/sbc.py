@@ -0,0 +1,550 @@
+"""Simulation-based calibration of the calibration model.
+
+Each replicate draws ln_offset, ln_sigma and height_T from the priors of
+scripts/fluxomics.stan, simulates heights for the design of a prepared Daria
+table (its metabolites, samples, isotopologues and natural fractions) under
+one or more error models, fits the simulated data and records, for every
+parameter, the rank of the true value among the posterior draws and whether
+the central intervals in INTERVALS contain it.
+
+The error models are:
+
+- "lognormal": the model's own likelihood, so with exact posterior draws
+  ranks should be uniform and coverage nominal.
+- "alr", "clr" and "ilr": the expected heights of each metabolite and sample
+  are closed into a composition, which gets normal noise with sd
+  exp(ln_sigma) on the free coordinates of that log-ratio transformation, as
+  in `cmfapoc.simulation`, and is scaled back to the total expected height.
+  Ranks and coverage then show how the model copes with compositional error.
+
+Fits use `cmfapoc.calibration.laplace` by default, which takes well under a
+second, or NUTS (`--nuts`). Both fit the heights on the scale they were
+simulated on, where the priors describe the true parameters:
+scripts/fluxomics.stan divides the heights by their mean, so NUTS fits use
+the variant from `unscaled_model`, which does not. NUTS results are SBC
+proper.
+
+Laplace fits are approximate: they check the model and the normal
+approximation at the joint mode together, and the joint mode underestimates
+the noise scales, so even under "lognormal" the ranks of ln_sigma are skewed
+high and its intervals, and those of ln_height, undercover. `summarise_sbc`
+marks their results as approximate. They are still useful to compare the
+error models with each other quickly, as they share the bias.
+
+Every (replicate, error model) result is written to its own Parquet file
+under `<out_dir>/replicates` as soon as it is done, so memory stays bounded
+however many replicates are run, and an interrupted run resumes where it
+stopped. `summarise_sbc` aggregates the files lazily.
+
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import cmdstanpy as cmd
+import numpy as np
+import polars as pl
+from numpy.typing import NDArray
+
+from cmfapoc.calibration import (
+    LN_HEIGHT_PRIOR_SD,
+    LN_OFFSET_PRIOR,
+    LN_SIGMA_PRIOR,
+    CalibrationData,
+    laplace,
+)
+from cmfapoc.data_preparation import ROOT, load_prepared
+from cmfapoc.fitting import fit_daria
+from cmfapoc.ragged import (
+    RAGGED_TRANSFORMATIONS,
+    Segments,
+    broadcast,
+    close,
+    free_coordinates,
+    segment_sum,
+)
+from cmfapoc.simulation import child_seed_sequence, draw_noise, seed_sequence
+from cmfapoc.stan_data import stan_input_daria
+from cmfapoc.stan_models import CACHE_DIR, compiled_model
+
+ERROR_MODELS = ("lognormal", "alr", "clr", "ilr")
+INTERVALS = (0.5, 0.9)
+N_POSTERIOR_DRAWS = 99
+STAN_FILE = ROOT / "scripts" / "fluxomics.stan"
+RESCALING = "rescaled_y = y./mean(y);"
+DESIGN_COLUMNS = ["sample", "metabolite", "isotopologue", "natural_fraction"]
+RESULT_SCHEMA = pl.Schema(
+    {
+        "replicate": pl.UInt32(),
+        "error_model": pl.String(),
+        "variable": pl.String(),
+        "index": pl.UInt32(),
+        "true": pl.Float64(),
+        "rank": pl.UInt32(),
+        "mean": pl.Float64(),
+        **{f"in_{round(100 * c)}": pl.Boolean() for c in INTERVALS},
+        "ok": pl.Boolean(),
+    }
+)
+
+_worker_design: tuple[pl.DataFrame, CalibrationData] | None = None
+
+
+def sbc_design(
+    measurements: pl.DataFrame,
+) -> tuple[pl.DataFrame, CalibrationData]:
+    """Get the design of a prepared Daria table.
+
+    Returns:
+        A tuple (table, data) of the rows with a measurement, sorted as in
+        `stan_input_daria`, and the model's data for them. Only the design
+        columns of `table` and the indices of `data` are used.
+    """
+    stan_input = stan_input_daria(measurements)
+    table = stan_input.table.select(DESIGN_COLUMNS)
+    return table, CalibrationData.from_stan_data(stan_input.data)
+
+
+def unscaled_model(
+    stan_file: Path = STAN_FILE,
+    cache_dir: Path = CACHE_DIR,
+) -> cmd.CmdStanModel:
+    """Compile a variant of the calibration model that does not rescale y.
+
+    The variant is the Stan program with RESCALING replaced, so that it fits
+    the heights as they are, like `cmfapoc.calibration.laplace` with a scale
+    of 1. Its source is written to `<cache_dir>/sbc` and compiled with
+    `compiled_model`.
+
+    Raises:
+        ValueError: If `stan_file` does not contain RESCALING.
+    """
+    source = stan_file.read_text()
+    if RESCALING not in source:
+        msg = f"{stan_file} does not contain {RESCALING!r}."
+        raise ValueError(msg)
+    variant = cache_dir / "sbc" / f"{stan_file.stem}_unscaled.stan"
+    variant.parent.mkdir(parents=True, exist_ok=True)
+    variant.write_text(source.replace(RESCALING, "rescaled_y = y;"))
+    return compiled_model(variant, cache_dir=cache_dir)
+
+
+def draw_parameters(
+    data: CalibrationData,
+    rng: np.random.Generator,
+) -> NDArray[np.float64]:
+    """Draw unconstrained parameters from the model's priors."""
+    return np.concatenate(
+        [
+            rng.normal(*LN_OFFSET_PRIOR, size=data.n_mets),
+            rng.normal(*LN_SIGMA_PRIOR, size=data.n_mets),
+            rng.normal(0.0, LN_HEIGHT_PRIOR_SD, size=data.n_met_samples),
+        ]
+    )
+
+
+def simulate_heights(
+    theta: NDArray[np.float64],
+    data: CalibrationData,
+    error_model: str,
+    seed: np.random.SeedSequence,
+) -> NDArray[np.float64]:
+    """Simulate one height per measurement of the design.
+
+    Args:
+        theta: Unconstrained parameters, as from `draw_parameters`.
+        data: The design's data. Its rows must be sorted by met_sample.
+        error_model: One of ERROR_MODELS.
+        seed: Seed for the noise.
+    """
+    ln_offset, ln_sigma, ln_height = data.split(theta)
+    expected = (
+        data.p_theoretical * np.exp(ln_height)[data.met_sample]
+        + np.exp(ln_offset)[data.met]
+    )
+    sigma = np.exp(ln_sigma)[data.met]
+    if error_model == "lognormal":
+        rng = np.random.default_rng(seed)
+        return expected * np.exp(sigma * rng.standard_normal(len(expected)))
+    if error_model not in RAGGED_TRANSFORMATIONS:
+        msg = f"Parameter 'error_model' must be one of: {list(ERROR_MODELS)}."
+        raise ValueError(msg)
+    segments = Segments.from_lengths(np.bincount(data.met_sample))
+    f, finv, _ = RAGGED_TRANSFORMATIONS[error_model]
+    z = f(close(expected, segments), segments)
+    free = free_coordinates(error_model, segments)
+    z[free] += draw_noise(seed, 0, free, segments) * sigma[free]
+    total = broadcast(segment_sum(expected, segments), segments)
+    return total * finv(z, segments)
+
+
+def _posterior_laplace(
+    data: CalibrationData,
+    n_draws: int,
+    seed: np.random.SeedSequence,
+) -> dict[str, NDArray] | None:
+    fit = laplace(data)
+    if not fit.ok:
+        return None
+    draws = fit.draws(n_draws, seed=np.random.default_rng(seed).integers(2**32))
+    return {
+        "ln_offset": draws["ln_offset"][0],
+        "ln_sigma": draws["ln_sigma"][0],
+        "ln_height": np.log(draws["height_T"][0]),
+    }
+
+
+def _posterior_nuts(
+    model: cmd.CmdStanModel,
+    measurements: pl.DataFrame,
+    n_draws: int,
+    chains: int,
+) -> dict[str, NDArray]:
+    # Replicates start cold, so that they are independent of each other and
+    # leave the warm start of the real data alone.
+    with TemporaryDirectory() as output_dir:
+        infd = fit_daria(
+            model,
+            measurements,
+            chains=chains,
+            output_dir=Path(output_dir),
+            warm_start=False,
+            variables=["ln_offset", "ln_sigma", "height_T"],
+        )
+    posterior = infd.posterior.stack(sample=("chain", "draw"))
+    keep = np.linspace(0, posterior.sizes["sample"] - 1, n_draws).astype(int)
+    return {
+        "ln_offset": posterior["ln_offset"].values.T[keep],
+        "ln_sigma": posterior["ln_sigma"].values.T[keep],
+        "ln_height": np.log(posterior["height_T"].values.T[keep]),
+    }
+
+
+def run_replicate(
+    table: pl.DataFrame,
+    data: CalibrationData,
+    replicate: int,
+    error_model: str,
+    root: np.random.SeedSequence,
+    n_draws: int = N_POSTERIOR_DRAWS,
+    model: cmd.CmdStanModel | None = None,
+    chains: int = 4,
+) -> pl.DataFrame:
+    """Simulate and fit one replicate under one error model.
+
+    The parameters of replicate r come from the stream (r, 0) of `root`, so
+    all error models share them, and the noise of error model j from the
+    stream (r, j + 1).
+
+    Returns:
+        One row per parameter, with the columns of RESULT_SCHEMA. If the fit
+        fails, or gives no draws of a parameter, "ok" is false and the rank
+        and interval columns are null.
+    """
+    theta = draw_parameters(
+        data, np.random.default_rng(child_seed_sequence(root, replicate, 0))
+    )
+    j = ERROR_MODELS.index(error_model)
+    noise_seed = child_seed_sequence(root, replicate, j + 1)
+    y = simulate_heights(theta, data, error_model, noise_seed)
+    if model is None:
+        simulated = replace(data, y=y, scale=1.0)
+        draws = _posterior_laplace(simulated, n_draws, noise_seed)
+    else:
+        measurements = table.with_columns(measurement=pl.Series(y))
+        draws = _posterior_nuts(model, measurements, n_draws, chains)
+    ln_offset, ln_sigma, ln_height = data.split(theta)
+    truth = {
+        "ln_offset": ln_offset,
+        "ln_sigma": ln_sigma,
+        "ln_height": ln_height,
+    }
+    frames = []
+    for variable, true in truth.items():
+        columns = {
+            "variable": variable,
+            "index": np.arange(len(true)),
+            "true": true,
+        }
+        if draws is not None and variable in draws:
+            d = draws[variable]
+            columns |= {
+                "rank": (d < true).sum(axis=0),
+                "mean": d.mean(axis=0),
+                "ok": True,
+            }
+            for c in INTERVALS:
+                lower, upper = np.quantile(d, [(1 - c) / 2, (1 + c) / 2], 0)
+                columns[f"in_{round(100 * c)}"] = (lower <= true) & (
+                    true <= upper
+                )
+        else:
+            columns["ok"] = False
+        frames.append(pl.DataFrame(columns))
+    df = pl.concat(frames, how="diagonal").with_columns(
+        replicate=replicate, error_model=pl.lit(error_model)
+    )
+    missing = [name for name in RESULT_SCHEMA if name not in df.columns]
+    return (
+        df.with_columns(pl.lit(None).alias(name) for name in missing)
+        .select(RESULT_SCHEMA.names())
+        .cast(dict(RESULT_SCHEMA))
+    )
+
+
+def _result_path(out_dir: Path, error_model: str, replicate: int) -> Path:
+    return out_dir / "replicates" / f"{error_model}-{replicate:05d}.parquet"
+
+
+def _write_atomic(df: pl.DataFrame, path: Path) -> None:
+    tmp = path.with_name(f".{path.stem}-{os.getpid()}.parquet")
+    df.write_parquet(tmp)
+    tmp.replace(path)
+
+
+def _init_worker(table: pl.DataFrame, data: CalibrationData) -> None:
+    global _worker_design
+    _worker_design = (table, data)
+
+
+def _run_task(
+    task: tuple[int, str, np.random.SeedSequence, int, Path],
+) -> None:
+    replicate, error_model, root, n_draws, out_dir = task
+    table, data = _worker_design
+    result = run_replicate(table, data, replicate, error_model, root, n_draws)
+    _write_atomic(result, _result_path(out_dir, error_model, replicate))
+
+
+def _check_config(out_dir: Path, config: dict) -> dict:
+    """Write the run's configuration, or check it against a previous one.
+
+    A previous run's entropy is reused if the new run has no seed.
+    """
+    path = out_dir / "config.json"
+    if not path.exists():
+        path.write_text(json.dumps(config, indent=2))
+        return config
+    previous = json.loads(path.read_text())
+    if config["entropy"] is None:
+        config = config | {"entropy": previous["entropy"]}
+    if previous != config:
+        msg = (
+            f"{out_dir} holds results of a different SBC run; use another "
+            "directory or the same settings."
+        )
+        raise ValueError(msg)
+    return config
+
+
+def run_sbc(
+    measurements: pl.DataFrame,
+    out_dir: Path,
+    n_replicates: int,
+    error_models: Sequence[str] = ERROR_MODELS,
+    n_draws: int = N_POSTERIOR_DRAWS,
+    seed: int | None = None,
+    model: cmd.CmdStanModel | None = None,
+    chains: int = 4,
+    max_workers: int | None = 1,
+) -> pl.DataFrame:
+    """Run SBC replicates that are not yet in `out_dir`, then summarise.
+
+    Args:
+        measurements: A prepared Daria table whose design is simulated.
+        out_dir: Directory for the results. Rerunning with the same settings
+            skips the replicates that are already there, so an interrupted
+            run can be resumed, or extended with a larger `n_replicates`.
+        n_replicates: Number of replicates per error model.
+        error_models: Error models to simulate with; see ERROR_MODELS.
+        n_draws: Number of posterior draws used for the ranks.
+        seed: Seed for the whole run, or None for fresh entropy, which is
+            stored so that resuming gives the same replicates.
+        model: A compiled calibration model to fit with NUTS, which must not
+            rescale the heights, e.g. from `unscaled_model`, or None to use
+            `cmfapoc.calibration.laplace`, whose results are approximate.
+        chains: Number of chains per NUTS fit.
+        max_workers: Number of worker processes for Laplace fits, or None for
+            one per CPU. NUTS fits run one at a time, each with `chains`
+            parallel chains.
+
+    Returns:
+        The output of `summarise_sbc`.
+    """
+    for error_model in error_models:
+        if error_model not in ERROR_MODELS:
+            msg = f"Unknown error model {error_model!r}."
+            raise ValueError(msg)
+    logger = logging.getLogger(__name__)
+    table, data = sbc_design(measurements)
+    (out_dir / "replicates").mkdir(parents=True, exist_ok=True)
+    config = {
+        "entropy": seed,
+        "n_draws": n_draws,
+        "fit": "laplace" if model is None else "nuts",
+        "design": hashlib.sha256(table.write_csv().encode()).hexdigest(),
+    }
+    if model is not None:
+        source = Path(model.stan_file).read_bytes()
+        config["model"] = hashlib.sha256(source).hexdigest()
+    config = _check_config(out_dir, config)
+    if config["entropy"] is None:
+        config["entropy"] = seed_sequence(None).entropy
+        (out_dir / "config.json").write_text(json.dumps(config, indent=2))
+    root = seed_sequence(config["entropy"])
+    todo = [
+        (replicate, error_model)
+        for replicate in range(n_replicates)
+        for error_model in error_models
+        if not _result_path(out_dir, error_model, replicate).exists()
+    ]
+    logger.info(f"{len(todo)} SBC fits to run in {out_dir}")
+    if model is None:
+        logger.warning(
+            "Fitting with the Laplace approximation: ranks and coverage are "
+            "approximate; pass a compiled model for SBC proper."
+        )
+    if model is not None:
+        for replicate, error_model in todo:
+            result = run_replicate(
+                table,
+                data,
+                replicate,
+                error_model,
+                root,
+                n_draws,
+                model,
+                chains,
+            )
+            _write_atomic(result, _result_path(out_dir, error_model, replicate))
+    elif max_workers == 1:
+        _init_worker(table, data)
+        for replicate, error_model in todo:
+            _run_task((replicate, error_model, root, n_draws, out_dir))
+    else:
+        # Forking a process that has used polars' thread pool can deadlock.
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(table, data),
+        ) as pool:
+            tasks = [(r, e, root, n_draws, out_dir) for r, e in todo]
+            for _ in pool.map(_run_task, tasks, chunksize=8):
+                pass
+    return summarise_sbc(out_dir)
+
+
+def summarise_sbc(out_dir: Path, n_bins: int = 10) -> pl.DataFrame:
+    """Aggregate the results in `out_dir` by error model and variable.
+
+    Args:
+        out_dir: Output directory of `run_sbc`.
+        n_bins: Number of rank histogram bins for the uniformity statistic.
+
+    Returns:
+        One row per error model and variable, with the fit method ("laplace"
+        or "nuts"), whether its posterior draws are approximate (true for
+        "laplace", whose ranks and coverage include the approximation's
+        bias), the number of replicates and failed fits, the coverage of
+        each interval in INTERVALS, the mean of rank / n_draws (0.5 if
+        calibrated) and the chi-squared statistic of the rank histogram,
+        which has n_bins - 1 degrees of freedom if the ranks are uniform.
+    """
+    config = json.loads((out_dir / "config.json").read_text())
+    n_draws = config["n_draws"]
+    keys = ["error_model", "variable"]
+    results = pl.scan_parquet(out_dir / "replicates" / "*.parquet")
+    ranked = results.filter(pl.col("rank").is_not_null())
+    histogram = (
+        ranked.with_columns(bin=pl.col("rank") * n_bins // (n_draws + 1))
+        .group_by(*keys, "bin")
+        .agg(count=pl.len())
+        .group_by(keys)
+        .agg(
+            rank_chi2=(
+                (pl.col("count") - pl.col("count").sum() / n_bins) ** 2
+            ).sum()
+            / (pl.col("count").sum() / n_bins)
+            # Empty bins have no row but add their expected count.
+            + (n_bins - pl.len()) * pl.col("count").sum() / n_bins
+        )
+    )
+    stats = results.group_by(keys).agg(
+        n_replicates=pl.col("replicate").n_unique(),
+        n_failed=pl.col("replicate").filter(~pl.col("ok")).n_unique(),
+        mean_rank=(pl.col("rank") / n_draws).mean(),
+        **{
+            f"coverage_{round(100 * c)}": pl.col(f"in_{round(100 * c)}").mean()
+            for c in INTERVALS
+        },
+    )
+    return (
+        stats.join(histogram, on=keys, how="left")
+        .select(
+            *keys,
+            pl.lit(config["fit"]).alias("fit"),
+            pl.lit(config["fit"] == "laplace").alias("approximate"),
+            *stats.collect_schema().names()[len(keys) :],
+            "rank_chi2",
+        )
+        .sort(keys)
+        .collect()
+    )
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--replicates", type=int, default=100)
+    parser.add_argument("--out-dir", type=Path, default=Path("sbc"))
+    parser.add_argument(
+        "--error-models",
+        nargs="+",
+        choices=ERROR_MODELS,
+        default=list(ERROR_MODELS),
+    )
+    parser.add_argument("--draws", type=int, default=N_POSTERIOR_DRAWS)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Worker processes for Laplace fits; defaults to one per CPU.",
+    )
+    parser.add_argument(
+        "--nuts",
+        action="store_true",
+        help=(
+            "Fit with NUTS and fluxomics.stan without rescaling. Without it, "
+            "fits use the Laplace approximation and results are "
+            "approximate."
+        ),
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    model = unscaled_model() if args.nuts else None
+    summary = run_sbc(
+        load_prepared("daria"),
+        args.out_dir,
+        args.replicates,
+        args.error_models,
+        n_draws=args.draws,
+        seed=args.seed,
+        model=model,
+        max_workers=args.workers,
+    )
+    with pl.Config(tbl_rows=-1, tbl_cols=-1):
+        print(summary)
+
+
+if __name__ == "__main__":
+    main()
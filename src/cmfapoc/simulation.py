@@ -7,24 +7,122 @@ The table containing the dataset must have the following columns:
 - measurement_id: the id of the measurement.
 - species: the name of the species.
 
+`simulate` transforms every composition in the dataset at once using the segment operations in `cmfapoc.ragged`; `simulate_compositional_measurement` handles a single composition using scikit-bio.
+
+`simulate_replicates`, `simulate_replicates_array` and `iter_replicates` simulate many noisy copies of the same dataset, transforming the data only once.
+
+Zero fractions would have no log ratio, so each composition is first passed
+through `cmfapoc.ragged.multiplicative_replacement`, which leaves compositions
+without zeros unchanged apart from closing them.
+
+`simulate_sweep` and `simulate_sweep_arrays` run the simulation for several transformations and error levels, optionally splitting the work into chunks of groups spread over a process pool. `simulate_sweep_sorted` does the same for fractions that are already sorted by group, such as those of `cmfapoc.wide.SergiMatrix`.
+
+Randomness comes from `numpy.random.SeedSequence` streams rather than NumPy's global random state. Each replicate, and within it each block of `GROUPS_PER_STREAM` consecutive (measurement_id, species) groups, draws its noise from its own spawned stream, so a seeded simulation gives the same result whether the replicates and groups are processed together, in chunks or in separate processes.
+
 """
 
-from functools import partial
+import os
+from collections.abc import Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Literal, NamedTuple
+
 import numpy as np
 import polars as pl
+from numpy.typing import NDArray
 from skbio.stats.composition import alr, alr_inv, clr, clr_inv, ilr, ilr_inv
 
+from cmfapoc.ragged import (
+    RAGGED_TRANSFORMATIONS,
+    Segments,
+    free_coordinates,
+    group_segments,
+    multiplicative_replacement,
+)
+
 TRANSFORMATIONS = {
     "alr": (alr, alr_inv),
     "clr": (clr, clr_inv),
     "ilr": (ilr, ilr_inv),
 }
+GROUPS_PER_STREAM = 256
+
+Seed = int | np.random.SeedSequence | np.random.Generator | None
+
+
+def seed_sequence(seed: Seed) -> np.random.SeedSequence:
+    """Get the root SeedSequence for a simulation.
+
+    Args:
+        seed: An integer, a SeedSequence (returned unchanged), a Generator
+            (from which fresh entropy is drawn) or None for fresh entropy from
+            the operating system.
+
+    Returns:
+        A SeedSequence.
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        return np.random.SeedSequence(seed.integers(2**63, size=4))
+    return np.random.SeedSequence(seed)
+
+
+def child_seed_sequence(
+    root: np.random.SeedSequence,
+    *key: int,
+) -> np.random.SeedSequence:
+    """Get the SeedSequence spawned from `root` at the path `key`.
+
+    Unlike `SeedSequence.spawn`, this does not depend on how many children
+    have been spawned before, so the same key always gives the same stream.
+    """
+    return np.random.SeedSequence(
+        root.entropy,
+        spawn_key=(*root.spawn_key, *key),
+        pool_size=root.pool_size,
+    )
+
+
+def draw_noise(
+    root: np.random.SeedSequence,
+    replicate: int,
+    free: NDArray[np.bool_],
+    segments: Segments,
+    first_block: int = 0,
+) -> NDArray[np.float64]:
+    """Draw standard normal noise for the free coordinates of one replicate.
+
+    Block b of `GROUPS_PER_STREAM` groups in replicate r uses the stream
+    `child_seed_sequence(root, r, b)`.
+
+    Args:
+        root: The root SeedSequence of the simulation.
+        replicate: Index of the replicate.
+        free: Mask of the free coordinates, as from `free_coordinates`.
+        segments: Segments of the sorted dataset.
+        first_block: Index of the first block in `segments`, when they are a
+            slice of a larger dataset starting at a block boundary.
+
+    Returns:
+        An array with one draw per True element of `free`, in sorted order.
+    """
+    n_free = np.concatenate([[0], np.cumsum(free)])
+    edges = np.append(segments.starts[::GROUPS_PER_STREAM], segments.size)
+    out = np.empty(n_free[-1])
+    for block, (lo, hi) in enumerate(
+        zip(n_free[edges[:-1]], n_free[edges[1:]])
+    ):
+        ss = child_seed_sequence(root, replicate, first_block + block)
+        out[lo:hi] = np.random.default_rng(ss).standard_normal(hi - lo)
+    return out
 
 
 def simulate_compositional_measurement(
     df: pl.DataFrame,
     error_sd: float,
     transformation: str = "clr",
+    seed: Seed = None,
 ) -> pl.DataFrame:
     """Simulate a single compositional measurement.
 
@@ -32,17 +130,18 @@ def simulate_compositional_measurement(
         df: A dataframe with a single measurement in the column "fraction".
         error_sd: The standard deviation of the error, on centered-log-ratio scale.
         transformation: name of the transformation to use. Options are "alr", "clr", and "ilr".
+        seed: Seed or Generator for `numpy.random.default_rng`.
 
     Returns:
         A series with the simulated measurements.
     """
-    if transformation not in TRANSFORMATIONS:
-        options = str(list(TRANSFORMATIONS.keys()))
-        msg = f"Parameter 'transformation' must be one of: {options}."
-        raise ValueError(msg)
+    _check_transformation(transformation)
     f, finv = TRANSFORMATIONS[transformation]
-    unconstrained = f(df["fraction"])
-    deviations = np.random.normal(size=unconstrained.shape) * error_sd
+    fraction = df["fraction"].to_numpy()
+    segments = Segments.from_lengths([len(fraction)])
+    unconstrained = f(multiplicative_replacement(fraction, segments))
+    rng = np.random.default_rng(seed)
+    deviations = rng.normal(size=unconstrained.shape) * error_sd
     sim_unconstrained = unconstrained + deviations
     return pl.DataFrame({"sim_fraction": finv(sim_unconstrained)})
 
@@ -51,24 +150,421 @@ def simulate(
     dataset: pl.DataFrame,
     error_sd: float = 0.1,
     transformation: str = "clr",
+    seed: Seed = None,
 ) -> pl.Series:
-    """Apply simulate_compositional_measurement to a dataset.
+    """Simulate every compositional measurement in a dataset.
+
+    This is equivalent to applying simulate_compositional_measurement to each
+    (measurement_id, species) group, but all groups are transformed together.
 
     Args:
         dataset: A dataframe with columns "fraction", "measurement_id" and "species".
         error_sd: The standard deviation of the error, on centered-log-ratio scale.
         transformation: name of the transformation to use. Options are "alr", "clr", and "ilr".
+        seed: Seed for the simulation; see `seed_sequence`.
 
     Returns:
-        A series with the simulated measurements.
+        A series with the simulated measurements, aligned with the rows of
+        `dataset`.
+    """
+    block = next(
+        iter_replicates(dataset, 1, error_sd, transformation, seed=seed)
+    )
+    return pl.Series("sim_fraction", block[0])
+
+
+def iter_replicates(
+    dataset: pl.DataFrame,
+    n_replicates: int,
+    error_sd: float = 0.1,
+    transformation: str = "clr",
+    chunk_size: int | None = None,
+    seed: Seed = None,
+) -> Iterator[NDArray[np.float64]]:
+    """Simulate replicates of a dataset in chunks.
+
+    The dataset is transformed to unconstrained space once; each chunk then
+    needs one draw of a (replicates x rows) block of noise and one inverse
+    transformation.
+
+    Args:
+        dataset: A dataframe with columns "fraction", "measurement_id" and "species".
+        n_replicates: The number of simulated copies of the dataset.
+        error_sd: The standard deviation of the error, on centered-log-ratio scale.
+        transformation: name of the transformation to use. Options are "alr", "clr", and "ilr".
+        chunk_size: The maximum number of replicates per chunk, or None to
+            simulate all replicates in one chunk.
+        seed: Seed for the simulation; see `seed_sequence`. Replicate r
+            uses the same streams regardless of `chunk_size`.
+
+    Yields:
+        Arrays with shape (replicates in chunk, rows of `dataset`).
+    """
+    _check_transformation(transformation)
+    if chunk_size is None:
+        chunk_size = max(n_replicates, 1)
+    if chunk_size < 1:
+        raise ValueError("Parameter 'chunk_size' must be positive.")
+    order, segments = group_segments(dataset, ["measurement_id", "species"])
+    f, finv, _ = RAGGED_TRANSFORMATIONS[transformation]
+    fraction = dataset["fraction"].to_numpy()[order]
+    unconstrained = f(multiplicative_replacement(fraction, segments), segments)
+    free = free_coordinates(transformation, segments)
+    root = seed_sequence(seed)
+    for start in range(0, n_replicates, chunk_size):
+        n = min(chunk_size, n_replicates - start)
+        block = np.tile(unconstrained, (n, 1))
+        for i in range(n):
+            noise = draw_noise(root, start + i, free, segments)
+            block[i, free] += noise * error_sd
+        sim = np.empty_like(block)
+        sim[:, order] = finv(block, segments)
+        yield sim
+
+
+def simulate_replicates_array(
+    dataset: pl.DataFrame,
+    n_replicates: int,
+    error_sd: float = 0.1,
+    transformation: str = "clr",
+    chunk_size: int | None = None,
+    seed: Seed = None,
+) -> NDArray[np.float64]:
+    """Simulate replicates of a dataset as an array.
+
+    Args:
+        dataset: A dataframe with columns "fraction", "measurement_id" and "species".
+        n_replicates: The number of simulated copies of the dataset.
+        error_sd: The standard deviation of the error, on centered-log-ratio scale.
+        transformation: name of the transformation to use. Options are "alr", "clr", and "ilr".
+        chunk_size: The maximum number of replicates to transform at once.
+        seed: Seed for the simulation; see `seed_sequence`.
+
+    Returns:
+        An array with shape (n_replicates, rows of `dataset`).
+    """
+    out = np.empty((n_replicates, len(dataset)))
+    start = 0
+    for block in iter_replicates(
+        dataset, n_replicates, error_sd, transformation, chunk_size, seed
+    ):
+        out[start : start + len(block)] = block
+        start += len(block)
+    return out
+
+
+def simulate_replicates(
+    dataset: pl.DataFrame,
+    n_replicates: int,
+    error_sd: float = 0.1,
+    transformation: str = "clr",
+    chunk_size: int | None = None,
+    seed: Seed = None,
+) -> pl.DataFrame:
+    """Simulate replicates of a dataset as a long-format table.
+
+    Args:
+        dataset: A dataframe with columns "fraction", "measurement_id" and "species".
+        n_replicates: The number of simulated copies of the dataset.
+        error_sd: The standard deviation of the error, on centered-log-ratio scale.
+        transformation: name of the transformation to use. Options are "alr", "clr", and "ilr".
+        chunk_size: The maximum number of replicates to transform at once.
+        seed: Seed for the simulation; see `seed_sequence`.
+
+    Returns:
+        The rows of `dataset` repeated once per replicate, with extra columns
+        "replicate" and "sim_fraction".
     """
-    sim_func = partial(
-        simulate_compositional_measurement,
-        error_sd=error_sd,
-        transformation=transformation,
+    frames = []
+    start = 0
+    for block in iter_replicates(
+        dataset, n_replicates, error_sd, transformation, chunk_size, seed
+    ):
+        n = len(block)
+        frames.append(
+            pl.concat([dataset] * n).with_columns(
+                replicate=pl.Series(
+                    np.repeat(np.arange(start, start + n), len(dataset)),
+                    dtype=pl.UInt32,
+                ),
+                sim_fraction=pl.Series(block.ravel()),
+            )
+        )
+        start += n
+    if not frames:
+        return dataset.clear().with_columns(
+            replicate=pl.Series([], dtype=pl.UInt32),
+            sim_fraction=pl.Series([], dtype=pl.Float64),
+        )
+    return pl.concat(frames)
+
+
+def _check_transformation(transformation: str) -> None:
+    if transformation not in TRANSFORMATIONS:
+        options = str(list(TRANSFORMATIONS.keys()))
+        msg = f"Parameter 'transformation' must be one of: {options}."
+        raise ValueError(msg)
+
+
+class _SweepTask(NamedTuple):
+    transformation: str
+    error_sd: float
+    seed: np.random.SeedSequence
+    first_group: int
+    last_group: int
+
+
+_worker_arrays: dict[str, NDArray] = {}
+_worker_memory: list[SharedMemory] = []
+
+
+def _attach_shared(specs: dict[str, tuple[str, tuple[int, ...], str]]) -> None:
+    """Pool initializer: map the parent's shared arrays into this process."""
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = SharedMemory(name=shm_name)
+        _worker_memory.append(shm)
+        _worker_arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _run_shared_task(task: _SweepTask) -> NDArray[np.float64]:
+    return _simulate_task(
+        _worker_arrays["fraction"], _worker_arrays["lengths"], task
+    )
+
+
+def _simulate_task(
+    fraction: NDArray[np.float64],
+    lengths: NDArray[np.intp],
+    task: _SweepTask,
+) -> NDArray[np.float64]:
+    """Simulate one chunk of groups of a group-sorted dataset.
+
+    Returns:
+        The simulated fractions of the chunk's rows, in sorted order.
+    """
+    segments = Segments.from_lengths(
+        lengths[task.first_group : task.last_group]
+    )
+    start = int(lengths[: task.first_group].sum())
+    x = fraction[start : start + segments.size]
+    f, finv, _ = RAGGED_TRANSFORMATIONS[task.transformation]
+    unconstrained = f(x, segments)
+    free = free_coordinates(task.transformation, segments)
+    first_block = task.first_group // GROUPS_PER_STREAM
+    noise = draw_noise(task.seed, 0, free, segments, first_block)
+    unconstrained[free] += noise * task.error_sd
+    return finv(unconstrained, segments)
+
+
+def simulate_sweep_arrays(
+    dataset: pl.DataFrame,
+    transformations: Sequence[str] = ("alr", "clr", "ilr"),
+    error_sds: Sequence[float] = (0.1,),
+    seed: Seed = None,
+    max_workers: int | None = 1,
+    groups_per_task: int | None = None,
+) -> dict[tuple[str, float], NDArray[np.float64]]:
+    """Simulate a dataset for every combination of transformation and error.
+
+    The work is split into tasks of (transformation, error_sd, chunk of
+    groups). With more than one worker the tasks run in a process pool; the
+    group-sorted fractions are placed in shared memory once, so that workers
+    read them without any dataframe being pickled. The result does not depend
+    on `max_workers` or `groups_per_task`.
+
+    Args:
+        dataset: A dataframe with columns "fraction", "measurement_id" and "species".
+        transformations: names of the transformations to use.
+        error_sds: The standard deviations of the error, without repeats.
+        seed: Seed for the simulation; see `seed_sequence`. The simulation
+            with the i-th error level and transformation t uses the child
+            stream with key (i, position of t in TRANSFORMATIONS).
+        max_workers: Number of worker processes, or None for one per CPU. With
+            1 worker, the tasks run in the current process.
+        groups_per_task: Number of groups per task. Must be a multiple of
+            GROUPS_PER_STREAM. By default the groups are split evenly over
+            the workers.
+
+    Returns:
+        A dictionary mapping (transformation, error_sd) to an array of
+        simulated fractions aligned with the rows of `dataset`.
+    """
+    order, segments = group_segments(dataset, ["measurement_id", "species"])
+    sims = simulate_sweep_sorted(
+        dataset["fraction"].to_numpy()[order],
+        segments,
+        transformations,
+        error_sds,
+        seed,
+        max_workers,
+        groups_per_task,
+    )
+    out = {}
+    for key, sim in sims.items():
+        out[key] = np.empty(segments.size)
+        out[key][order] = sim
+    return out
+
+
+def simulate_sweep_sorted(
+    fraction: NDArray[np.float64],
+    segments: Segments,
+    transformations: Sequence[str] = ("alr", "clr", "ilr"),
+    error_sds: Sequence[float] = (0.1,),
+    seed: Seed = None,
+    max_workers: int | None = 1,
+    groups_per_task: int | None = None,
+) -> dict[tuple[str, float], NDArray[np.float64]]:
+    """Simulate group-sorted fractions for every transformation and error.
+
+    This is `simulate_sweep_arrays` for fractions that are already sorted by
+    (measurement_id, species) group, e.g. the flattened matrix of a
+    `cmfapoc.wide.SergiMatrix`. Given the same groups in the same order, both
+    functions draw the same noise.
+
+    Args:
+        fraction: Fractions of every group, one group after another.
+        segments: Segments of `fraction`, one per group.
+        transformations: names of the transformations to use.
+        error_sds: The standard deviations of the error.
+        seed: Seed for the simulation; see `simulate_sweep_arrays`.
+        max_workers: Number of worker processes; see `simulate_sweep_arrays`.
+        groups_per_task: Number of groups per task; see
+            `simulate_sweep_arrays`.
+
+    Returns:
+        A dictionary mapping (transformation, error_sd) to an array of
+        simulated fractions in the same order as `fraction`.
+    """
+    for transformation in transformations:
+        _check_transformation(transformation)
+    # Results are keyed by (transformation, error_sd), so a repeated value
+    # would silently overwrite an earlier simulation.
+    for name, values in (
+        ("transformations", transformations),
+        ("error_sds", error_sds),
+    ):
+        if len(set(values)) != len(values):
+            msg = f"Parameter '{name}' must not repeat values, got {values}."
+            raise ValueError(msg)
+    fraction = np.ascontiguousarray(
+        multiplicative_replacement(fraction, segments)
+    )
+    n_workers = (os.cpu_count() or 1) if max_workers is None else max_workers
+    if groups_per_task is None:
+        n_blocks = -(-segments.n_segments // GROUPS_PER_STREAM)
+        groups_per_task = GROUPS_PER_STREAM * max(-(-n_blocks // n_workers), 1)
+    if groups_per_task < 1 or groups_per_task % GROUPS_PER_STREAM != 0:
+        msg = (
+            "Parameter 'groups_per_task' must be a positive multiple of "
+            f"{GROUPS_PER_STREAM}."
+        )
+        raise ValueError(msg)
+    root = seed_sequence(seed)
+    tasks = [
+        _SweepTask(
+            transformation,
+            error_sd,
+            child_seed_sequence(
+                root, i, list(TRANSFORMATIONS).index(transformation)
+            ),
+            first_group,
+            min(first_group + groups_per_task, segments.n_segments),
+        )
+        for i, error_sd in enumerate(error_sds)
+        for transformation in transformations
+        for first_group in range(0, segments.n_segments, groups_per_task)
+    ]
+    if n_workers == 1:
+        chunks = [_simulate_task(fraction, segments.lengths, t) for t in tasks]
+    else:
+        chunks = _run_in_pool(
+            tasks,
+            {"fraction": fraction, "lengths": segments.lengths},
+            n_workers,
+        )
+    out = {}
+    for task, chunk in zip(tasks, chunks):
+        key = (task.transformation, task.error_sd)
+        if key not in out:
+            out[key] = np.empty(segments.size)
+        start = segments.starts[task.first_group]
+        out[key][start : start + len(chunk)] = chunk
+    return out
+
+
+def _run_in_pool(
+    tasks: list[_SweepTask],
+    arrays: dict[str, NDArray],
+    max_workers: int,
+) -> list[NDArray[np.float64]]:
+    """Run sweep tasks in a process pool, sharing `arrays` with the workers."""
+    shared = []
+    try:
+        specs = {}
+        for name, array in arrays.items():
+            shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared.append(shm)
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            view[...] = array
+            specs[name] = (shm.name, array.shape, array.dtype.str)
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_attach_shared,
+            initargs=(specs,),
+        ) as pool:
+            return list(pool.map(_run_shared_task, tasks))
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+
+def simulate_sweep(
+    dataset: pl.DataFrame,
+    transformations: Sequence[str] = ("alr", "clr", "ilr"),
+    error_sds: Sequence[float] = (0.1,),
+    seed: Seed = None,
+    max_workers: int | None = 1,
+    groups_per_task: int | None = None,
+    layout: Literal["wide", "long"] = "wide",
+) -> pl.DataFrame:
+    """Simulate a dataset for every combination of transformation and error.
+
+    See `simulate_sweep_arrays` for the meaning of the arguments.
+
+    Args:
+        layout: With "wide", `dataset` is returned with one column
+            "sim_fraction_{transformation}_{error_sd}" per combination. With
+            "long", the rows of `dataset` are repeated once per combination,
+            with extra columns "transformation", "error_sd" and
+            "sim_fraction".
+
+    Returns:
+        A dataframe with the simulated fractions.
+    """
+    sims = simulate_sweep_arrays(
+        dataset,
+        transformations,
+        error_sds,
+        seed,
+        max_workers,
+        groups_per_task,
+    )
+    if layout == "wide":
+        return dataset.with_columns(
+            pl.Series(f"sim_fraction_{t}_{sd}", sim)
+            for (t, sd), sim in sims.items()
+        )
+    if layout != "long":
+        raise ValueError("Parameter 'layout' must be 'wide' or 'long'.")
+    return pl.concat(
+        [
+            dataset.with_columns(
+                transformation=pl.lit(t),
+                error_sd=pl.lit(sd, dtype=pl.Float64),
+                sim_fraction=pl.Series(sim),
+            )
+            for (t, sd), sim in sims.items()
+        ]
     )
-    return dataset.group_by(
-        "measurement_id",
-        "species",
-        maintain_order=True,
-    ).map_groups(sim_func)["sim_fraction"]
@@ -0,0 +1,96 @@
+"""Code for turning prepared datasets into input for Stan models.
+
+All indexing is done with native polars expressions: dense 1-based indices
+come from `rank("dense")`, which numbers the distinct values in sorted order.
+The arrays in the returned input are zero-copy views of the columns of one
+rechunked dataframe.
+
+"""
+
+from typing import Any, NamedTuple
+
+import polars as pl
+from numpy.typing import NDArray
+
+# Variables of the calibration model's posterior that are kept after a fit.
+POSTERIOR_VARIABLES = [
+    "ln_offset",
+    "true_offset",
+    "height_T",
+    "rescaled_height_offset",
+]
+
+
+class StanInput(NamedTuple):
+    """Input data for a Stan model, with coordinates for its outputs.
+
+    Attributes:
+        data: The data dictionary to pass to cmdstanpy.
+        coords: Labels for the dimensions of the model's variables, in the
+            order of the indices in `data`.
+        table: The rows that the data arrays were taken from.
+    """
+
+    data: dict[str, Any]
+    coords: dict[str, list[str]]
+    table: pl.DataFrame
+
+
+def dense_index(*columns: str) -> pl.Expr:
+    """Dense 1-based index of the distinct values of one or more columns."""
+    expr = pl.col(columns[0]) if len(columns) == 1 else pl.struct(columns)
+    return expr.rank("dense").cast(pl.Int32)
+
+
+def _view(df: pl.DataFrame, column: str) -> NDArray:
+    return df[column].to_numpy(allow_copy=False)
+
+
+def stan_input_daria(measurements: pl.DataFrame) -> StanInput:
+    """Get the input for fluxomics.stan from Daria's prepared data.
+
+    Rows without a measurement are dropped, as the model's lognormal
+    likelihood needs positive heights.
+
+    Args:
+        measurements: Output of `prepare_data_daria`.
+
+    Returns:
+        A StanInput with coordinates "met" and "met_sample".
+    """
+    table = (
+        measurements.lazy()
+        .filter(pl.col("measurement").is_not_null())
+        .with_columns(
+            met=dense_index("metabolite"),
+            sample_ix=dense_index("sample"),
+            met_sample_ix=dense_index("metabolite", "sample"),
+            met_sample=pl.concat_str(["metabolite", "sample"], separator="|"),
+        )
+        .sort("met_sample_ix", "isotopologue")
+        .collect()
+        .rechunk()
+    )
+    counts = table.select(
+        N_mets=pl.col("met").max(),
+        N_samples=pl.col("sample_ix").max(),
+        N_met_samples=pl.col("met_sample_ix").max(),
+    ).row(0, named=True)
+    data = {
+        "N_meas": len(table),
+        **{k: int(v) for k, v in counts.items()},
+        "mets": _view(table, "met"),
+        "met_samples": _view(table, "met_sample_ix"),
+        "p_theoretical": _view(table, "natural_fraction"),
+        "y": _view(table, "measurement"),
+    }
+    coords = {
+        "met": _labels(table, "met", "metabolite"),
+        "met_sample": _labels(table, "met_sample_ix", "met_sample"),
+    }
+    return StanInput(data=data, coords=coords, table=table)
+
+
+def _labels(table: pl.DataFrame, index: str, label: str) -> list[str]:
+    """Get the label of each value of a dense index, in index order."""
+    return table.select(index, label).unique().sort(index)[label].to_list()
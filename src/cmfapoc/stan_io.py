@@ -0,0 +1,160 @@
+"""Code for passing data to CmdStan and reading its output efficiently.
+
+CmdStan only reads input data as JSON, so `data_file` writes each distinct
+input once, to a file named after a hash of its content, and the same path can
+be passed to every method (pathfinder, sampling, ...) that uses it.
+
+`read_draws` reads selected variables from CmdStan's output CSV files. Only
+the columns of the requested variables are parsed, using polars' multi-threaded
+CSV reader, one variable of one chain at a time, and each variable can be
+stored as a memory-mapped .npy file so that later reads need no parsing at
+all.
+
+"""
+
+import hashlib
+import re
+from collections.abc import Iterable, Mapping, Sequence
+from pathlib import Path
+from typing import Any
+
+import cmdstanpy as cmd
+import numpy as np
+import polars as pl
+from numpy.typing import NDArray
+
+COLUMN_RE = re.compile(r"^(?P<name>[^.]+)(?P<index>(\.\d+)*)$")
+
+
+def data_file(data: Mapping[str, Any], cache_dir: Path) -> Path:
+    """Write Stan input data to a JSON file named after its content.
+
+    Args:
+        data: Stan input data.
+        cache_dir: Directory for the data files.
+
+    Returns:
+        Path of the JSON file, which is only written if it does not exist.
+    """
+    h = hashlib.sha256()
+    for key, value in sorted(data.items()):
+        h.update(key.encode())
+        array = np.ascontiguousarray(value)
+        h.update(str((array.dtype, array.shape)).encode())
+        h.update(array.tobytes())
+    path = cache_dir / f"{h.hexdigest()[:16]}.json"
+    if not path.exists():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        cmd.write_stan_json(str(tmp_path), data)
+        tmp_path.replace(path)
+    return path
+
+
+def read_header(csv_file: Path) -> list[str]:
+    """Get the column names of a CmdStan output CSV file."""
+    with open(csv_file) as f:
+        for line in f:
+            if not line.startswith("#"):
+                return line.strip().split(",")
+    raise ValueError(f"No header found in {csv_file}.")
+
+
+def variable_columns(header: Sequence[str]) -> dict[str, list[str]]:
+    """Group the columns of a CmdStan CSV header by variable name."""
+    out: dict[str, list[str]] = {}
+    for column in header:
+        match = COLUMN_RE.match(column)
+        name = match["name"] if match else column
+        out.setdefault(name, []).append(column)
+    return out
+
+
+def _column_index(column: str) -> tuple[int, ...]:
+    index = COLUMN_RE.match(column)["index"]
+    return tuple(int(i) - 1 for i in index.split(".")[1:])
+
+
+def _read_columns(csv_file: Path, columns: Sequence[str]) -> pl.DataFrame:
+    """Read some columns of a CmdStan output CSV file as Float64."""
+    return (
+        pl.scan_csv(
+            csv_file,
+            comment_prefix="#",
+            schema_overrides={c: pl.Float64 for c in columns},
+        )
+        .select(columns)
+        .collect(engine="streaming")
+    )
+
+
+def read_draws(
+    csv_files: Sequence[Path],
+    variables: Iterable[str] | None = None,
+    store_dir: Path | None = None,
+) -> dict[str, NDArray]:
+    """Read draws of selected variables from CmdStan output CSV files.
+
+    Args:
+        csv_files: One output CSV file per chain, e.g. `fit.runset.csv_files`.
+        variables: Names of the variables to read, including sampler
+            diagnostics such as "lp__". None reads every variable.
+        store_dir: If given, each variable is written to a .npy file in this
+            directory and returned as a read-only memory map.
+
+    Each variable of each chain is read by its own projected scan of the
+    chain's file, so besides the returned arrays, which are on disk if
+    `store_dir` is given, memory holds the draws of one variable of one
+    chain at a time. The price is one pass over each file per variable.
+
+    Returns:
+        A dictionary mapping each variable to an array with shape
+        (chain, draw, *variable dimensions), as expected by `az.from_dict`.
+    """
+    csv_files = [Path(f) for f in csv_files]
+    columns = variable_columns(read_header(csv_files[0]))
+    names = list(columns) if variables is None else list(variables)
+    missing = [name for name in names if name not in columns]
+    if missing:
+        raise ValueError(f"Variables not found in output: {missing}.")
+    n_draws = None
+    out = {}
+    for name in names:
+        indexes = [_column_index(c) for c in columns[name]]
+        dims = tuple(max(ix) + 1 for ix in zip(*indexes))
+        array = None
+        for chain_ix, f in enumerate(csv_files):
+            chain = _read_columns(f, columns[name])
+            if n_draws is None:
+                n_draws = len(chain)
+            if array is None:
+                shape = (len(csv_files), n_draws, *dims)
+                if store_dir is None:
+                    array = np.empty(shape)
+                else:
+                    store_dir.mkdir(parents=True, exist_ok=True)
+                    array = np.lib.format.open_memmap(
+                        store_dir / f"{name}.npy", mode="w+", shape=shape
+                    )
+            for column, index in zip(columns[name], indexes):
+                values = chain[column].to_numpy()
+                array[(chain_ix, slice(None), *index)] = values
+            del chain
+        if store_dir is not None:
+            array.flush()
+            array = np.load(store_dir / f"{name}.npy", mmap_mode="r")
+        out[name] = array
+    return out
+
+
+def load_draws(
+    store_dir: Path,
+    variables: Iterable[str] | None = None,
+) -> dict[str, NDArray]:
+    """Memory-map variables previously stored by `read_draws`."""
+    paths = (
+        sorted(store_dir.glob("*.npy"))
+        if variables is None
+        else [store_dir / f"{name}.npy" for name in variables]
+    )
+    return {p.stem: np.load(p, mmap_mode="r") for p in paths}
@@ -0,0 +1,215 @@
+"""Code for reusing compiled Stan models and sampler adaptation between fits.
+
+Compiled executables are cached in a directory named after a hash of the Stan
+source, the compiler options and the CmdStan version, so a model is only
+compiled once per change, whatever checkout or working directory it is run
+from.
+
+After a fit, the last draw of each chain, the adapted step sizes and the
+adapted inverse metric can be saved as a `WarmStart`, keyed by a fingerprint of
+the model and the shape of the data. A later fit of similar data can then start
+from these values with a much shorter warmup.
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from collections.abc import Mapping
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import cmdstanpy as cmd
+import numpy as np
+from numpy.typing import NDArray
+
+from cmfapoc.stan_io import read_draws
+
+ROOT = Path(__file__).parent.parent.parent
+CACHE_DIR = ROOT / ".cache" / "stan"
+WARM_ITER_WARMUP = 300
+
+
+def model_hash(
+    stan_file: Path,
+    cpp_options: Mapping[str, Any] | None = None,
+    stanc_options: Mapping[str, Any] | None = None,
+) -> str:
+    """Hash a Stan program together with the options used to compile it."""
+    h = hashlib.sha256(Path(stan_file).read_bytes())
+    options = {
+        "cpp_options": dict(cpp_options or {}),
+        "stanc_options": dict(stanc_options or {}),
+        "cmdstan": cmd.cmdstan_version(),
+    }
+    h.update(json.dumps(options, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def compiled_model(
+    stan_file: Path,
+    cpp_options: Mapping[str, Any] | None = None,
+    stanc_options: Mapping[str, Any] | None = None,
+    cache_dir: Path = CACHE_DIR,
+) -> cmd.CmdStanModel:
+    """Get a compiled model, compiling it only if it is not in the cache.
+
+    Args:
+        stan_file: Path to the Stan program.
+        cpp_options: C++ compiler options, e.g. {"STAN_THREADS": True}.
+        stanc_options: Stan compiler options.
+        cache_dir: Directory holding one subdirectory per compiled model.
+
+    Returns:
+        A CmdStanModel whose executable lives in the cache.
+    """
+    stan_file = Path(stan_file)
+    model_dir = (
+        cache_dir / model_hash(stan_file, cpp_options, stanc_options)[:16]
+    )
+    cached_stan_file = model_dir / stan_file.name
+    exe_file = cached_stan_file.with_suffix("")
+    if exe_file.exists():
+        return cmd.CmdStanModel(stan_file=cached_stan_file, exe_file=exe_file)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(stan_file, cached_stan_file)
+    return cmd.CmdStanModel(
+        stan_file=cached_stan_file,
+        cpp_options=dict(cpp_options) if cpp_options else None,
+        stanc_options=dict(stanc_options) if stanc_options else None,
+    )
+
+
+def data_fingerprint(model: cmd.CmdStanModel, data: Mapping[str, Any]) -> str:
+    """Fingerprint a model and the shape of its input data.
+
+    Two datasets with the same sizes get the same fingerprint, so that a
+    re-fit of new measurements of the same design can reuse a warm start.
+    """
+    shape = {
+        k: (v if isinstance(v, int) else list(np.shape(v)))
+        for k, v in sorted(data.items())
+    }
+    h = hashlib.sha256(Path(model.exe_file).parent.name.encode())
+    h.update(Path(model.stan_file).read_bytes())
+    h.update(json.dumps(shape).encode())
+    return h.hexdigest()[:16]
+
+
+@dataclass
+class WarmStart:
+    """Initial values and sampler adaptation saved from a previous fit.
+
+    Attributes:
+        inits: One dictionary of parameter values per chain.
+        step_size: Adapted step size of each chain.
+        inv_metric: Adapted inverse metric of each chain.
+        metric_type: CmdStan metric type, e.g. "diag_e".
+    """
+
+    inits: list[dict[str, NDArray]]
+    step_size: NDArray
+    inv_metric: NDArray
+    metric_type: str
+
+    @classmethod
+    def from_fit(
+        cls,
+        fit: cmd.CmdStanMCMC,
+        parameters: list[str],
+    ) -> "WarmStart":
+        """Get the last draw of each chain and the adaptation of a fit.
+
+        Args:
+            fit: A finished MCMC fit with an adapted diagonal or dense metric.
+            parameters: Names of the model's parameters.
+        """
+        draws = read_draws(fit.runset.csv_files, parameters)
+        return cls(
+            inits=[
+                {name: draws[name][chain, -1] for name in parameters}
+                for chain in range(fit.chains)
+            ],
+            step_size=np.asarray(fit.step_size),
+            inv_metric=np.asarray(fit.inv_metric),
+            metric_type=fit.metric_type,
+        )
+
+    def save(self, path: Path) -> None:
+        """Save to a .npz file."""
+        arrays = {
+            f"init/{chain}/{name}": np.asarray(value)
+            for chain, init in enumerate(self.inits)
+            for name, value in init.items()
+        }
+        np.savez(
+            path,
+            step_size=self.step_size,
+            inv_metric=self.inv_metric,
+            metric_type=np.array(self.metric_type),
+            **arrays,
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "WarmStart":
+        """Load from a .npz file written by `save`."""
+        with np.load(path) as f:
+            inits: dict[int, dict[str, NDArray]] = {}
+            for key in f.files:
+                if key.startswith("init/"):
+                    _, chain, name = key.split("/")
+                    inits.setdefault(int(chain), {})[name] = f[key]
+            return cls(
+                inits=[inits[chain] for chain in sorted(inits)],
+                step_size=f["step_size"],
+                inv_metric=f["inv_metric"],
+                metric_type=str(f["metric_type"]),
+            )
+
+    def sample_kwargs(self, chains: int) -> dict[str, Any]:
+        """Keyword arguments for `CmdStanModel.sample` that use this start.
+
+        Chains beyond the number saved reuse the saved chains in turn.
+        """
+        ix = [i % len(self.inits) for i in range(chains)]
+        return {
+            "inits": [
+                {k: v.tolist() for k, v in self.inits[i].items()} for i in ix
+            ],
+            "step_size": [float(self.step_size[i]) for i in ix],
+            "metric": [{"inv_metric": self.inv_metric[i].tolist()} for i in ix],
+            "iter_warmup": WARM_ITER_WARMUP,
+        }
+
+
+def warm_start_path(fingerprint: str, cache_dir: Path = CACHE_DIR) -> Path:
+    """Get the path where the warm start for a fingerprint is stored."""
+    return cache_dir / "warm" / f"{fingerprint}.npz"
+
+
+def load_warm_start(
+    fingerprint: str,
+    cache_dir: Path = CACHE_DIR,
+) -> WarmStart | None:
+    """Load the warm start for a fingerprint, or None if there is none."""
+    path = warm_start_path(fingerprint, cache_dir)
+    return WarmStart.load(path) if path.exists() else None
+
+
+def save_warm_start(
+    warm_start: WarmStart,
+    fingerprint: str,
+    cache_dir: Path = CACHE_DIR,
+) -> None:
+    """Save the warm start for a fingerprint.
+
+    The file is replaced atomically, so concurrent fits of data with the same
+    fingerprint never leave a partly written warm start.
+    """
+    path = warm_start_path(fingerprint, cache_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.stem}-{os.getpid()}.npz")
+    warm_start.save(tmp_path)
+    tmp_path.replace(path)
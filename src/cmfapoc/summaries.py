@@ -0,0 +1,175 @@
+"""Quantile summaries of posterior draws, and forest plots drawn from them.
+
+`summarise_draws` reduces every variable of a fit to one row per element, with
+its mean, sd and the quantiles in QUANTILES, in one vectorized pass over the
+draws. The summaries of many runs are stored together in a Parquet table
+keyed by run, so forest plots can be drawn, redrawn and compared across runs
+without loading any draws:
+
+>>> summary = summarise_inference_data(infd, POSTERIOR_VARIABLES, run="daria")
+>>> write_summary(summary, Path("posterior_summary.parquet"))
+>>> save_forest(read_summaries(paths), "ln_offset", Path("ln_offsets.png"))
+
+The plots show the median as a point, the 25-75% interval as a thick line and
+the 3-97% interval as a thin line, like ArviZ's forest plots with quantile
+intervals instead of HDIs.
+
+"""
+
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+
+import arviz as az
+import matplotlib.pyplot as plt
+import numpy as np
+import polars as pl
+from matplotlib.axes import Axes
+from numpy.typing import NDArray
+
+QUANTILES = (0.03, 0.25, 0.5, 0.75, 0.97)
+QUANTILE_COLUMNS = [f"q{round(100 * q)}" for q in QUANTILES]
+SUMMARY_FILE = "posterior_summary.parquet"
+
+
+def summarise_draws(
+    draws: Mapping[str, NDArray],
+    labels: Mapping[str, Sequence[str]] | None = None,
+    run: str = "",
+) -> pl.DataFrame:
+    """Summarise the draws of several variables.
+
+    Args:
+        draws: Arrays with shape (chain, draw, ...) for each variable.
+        labels: Label of each element of a variable, in flattened order. By
+            default elements are labelled by their index, e.g. "[2,0]".
+        run: Name of the run, stored in the "run" column.
+
+    Returns:
+        One row per element of each variable, with columns "run",
+        "variable", "label", "index", "mean", "sd" and QUANTILE_COLUMNS.
+    """
+    labels = labels or {}
+    names, flat, label_lists = [], [], []
+    for name, values in draws.items():
+        values = np.asarray(values, dtype=np.float64)
+        n_samples = values.shape[0] * values.shape[1]
+        block = values.reshape(n_samples, -1)
+        flat.append(block)
+        names += [name] * block.shape[1]
+        label_lists += (
+            list(labels[name])
+            if name in labels
+            else [
+                "[" + ",".join(map(str, i)) + "]"
+                for i in np.ndindex(*values.shape[2:])
+            ]
+        )
+    matrix = np.concatenate(flat, axis=1)
+    quantiles = np.quantile(matrix, QUANTILES, axis=0)
+    return pl.DataFrame(
+        {
+            "run": [run] * len(names),
+            "variable": names,
+            "label": label_lists,
+            "index": np.concatenate(
+                [np.arange(block.shape[1]) for block in flat]
+            ),
+            "mean": matrix.mean(axis=0),
+            "sd": matrix.std(axis=0, ddof=1),
+            **dict(zip(QUANTILE_COLUMNS, quantiles)),
+        }
+    )
+
+
+def summarise_inference_data(
+    infd: az.InferenceData,
+    variables: Sequence[str],
+    run: str = "",
+) -> pl.DataFrame:
+    """Summarise posterior variables, labelled by their coordinates.
+
+    Elements of variables with one dimension are labelled by that
+    dimension's coordinates, and other elements by their index.
+    """
+    draws, labels = {}, {}
+    for name in variables:
+        array = infd.posterior[name]
+        draws[name] = array.values
+        if array.ndim == 3:
+            labels[name] = array[array.dims[2]].values.astype(str).tolist()
+    return summarise_draws(draws, labels, run)
+
+
+def write_summary(summary: pl.DataFrame, path: Path) -> None:
+    """Write summaries to Parquet, replacing the runs they contain."""
+    if path.exists():
+        runs = summary["run"].unique()
+        kept = pl.read_parquet(path).filter(~pl.col("run").is_in(runs))
+        summary = pl.concat([kept, summary])
+    summary.write_parquet(path)
+
+
+def read_summaries(paths: Sequence[Path]) -> pl.DataFrame:
+    """Read and concatenate summary tables."""
+    return pl.concat([pl.read_parquet(p) for p in paths])
+
+
+def plot_forest(
+    summary: pl.DataFrame,
+    variable: str,
+    ax: Axes,
+    log_scale: bool = False,
+) -> Axes:
+    """Draw a forest plot of one variable from its summaries.
+
+    Each label is one row, with one interval per run, offset vertically, so
+    runs with different elements (e.g. different metabolites) line up by
+    label. Labels are in order of their index in the first run that has them.
+
+    Args:
+        summary: Summaries of one or more runs.
+        variable: Name of the variable to plot.
+        ax: Axes to draw on.
+        log_scale: Whether to use a log scale for the values.
+    """
+    rows = summary.filter(pl.col("variable") == variable).sort("index", "run")
+    if rows.is_empty():
+        msg = f"No summaries of variable {variable!r}."
+        raise ValueError(msg)
+    runs = rows["run"].unique().sort().to_list()
+    labels = rows.unique("label", keep="first", maintain_order=True)["label"]
+    rows = rows.join(
+        labels.to_frame().with_row_index("row"), on="label", how="left"
+    )
+    height = 0.8 / len(runs)
+    for i, run in enumerate(runs):
+        r = rows.filter(pl.col("run") == run)
+        y = -(r["row"].to_numpy() + i * height)
+        ax.hlines(y, r["q3"], r["q97"], color=f"C{i}", linewidth=1)
+        ax.hlines(y, r["q25"], r["q75"], color=f"C{i}", linewidth=3)
+        ax.plot(r["q50"], y, "o", color=f"C{i}", markersize=3, label=run)
+    centre = (len(runs) - 1) * height / 2
+    ax.set_yticks(-(np.arange(len(labels)) + centre), labels)
+    ax.set_title(variable)
+    if log_scale:
+        ax.set_xscale("log")
+    if len(runs) > 1:
+        ax.legend()
+    return ax
+
+
+def save_forest(
+    summary: pl.DataFrame,
+    variable: str,
+    path: Path,
+    log_scale: bool = False,
+) -> None:
+    """Draw a forest plot of one variable to a file and close its figure."""
+    n_rows = summary.filter(pl.col("variable") == variable)["label"].n_unique()
+    fig, ax = plt.subplots(figsize=(6.4, min(max(4.8, 0.15 * n_rows), 60)))
+    try:
+        plot_forest(summary, variable, ax, log_scale)
+        fig.tight_layout()
+        fig.savefig(path)
+    finally:
+        plt.close(fig)
@@ -0,0 +1,190 @@
+"""Sergi's pivot table as a dense matrix.
+
+`prepare_data_sergi` unpivots the pivot table into one row per isotopologue
+and measurement, repeating the species and measurement strings on every row
+and extracting the sample and replicate ids from each of them. `SergiMatrix`
+instead keeps the "peak_apex_int" block as it is in the file: a dense float
+array with one row per isotopologue and one column per measurement, plus the
+`Segments` of the species along the rows. The ids are parsed once per column
+header, and closure and simulation are segment operations on the columns:
+
+>>> matrix = SergiMatrix.from_raw(pl.read_csv(RAW_FILES["sergi"][0]))
+>>> matrix.fraction.shape
+(141, 52)
+>>> matrix.to_long(seed=0)  # same as prepare_data_sergi(raw, seed=0)
+
+The long table is only built by `to_long`.
+
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import polars as pl
+from numpy.typing import NDArray
+
+from cmfapoc.data_preparation import (
+    REPLICATE_ID_DTYPE,
+    SAMPLE_ID_DTYPE,
+    SIM_ERROR_SD,
+)
+from cmfapoc.ragged import Segments, close, group_segments
+from cmfapoc.simulation import Seed, simulate_sweep_sorted
+
+MEASUREMENT_ID_RE = r"ID_(\d+)_rep_(\d+)"
+INDEX_COLUMNS = ["component_name", "component_group_name", "meta_value"]
+
+
+@dataclass(frozen=True)
+class SergiMatrix:
+    """The peak intensities of Sergi's dataset as a matrix.
+
+    Attributes:
+        raw_fraction: Peak intensities with shape (isotopologues,
+            measurements). The isotopologues of each species are contiguous.
+        isotopologue: Name of the isotopologue of each row.
+        species: Name of the species of each row.
+        segments: Segments of the rows, one per species.
+        measurement_id: Name of each column, e.g. "ID_10_rep_2".
+        sample_id: Sample id of each column.
+        replicate_id: Replicate id of each column.
+    """
+
+    raw_fraction: NDArray[np.float64]
+    isotopologue: pl.Series
+    species: pl.Series
+    segments: Segments
+    measurement_id: pl.Series
+    sample_id: NDArray[np.int64]
+    replicate_id: NDArray[np.int64]
+
+    @classmethod
+    def from_raw(cls, raw: pl.DataFrame) -> "SergiMatrix":
+        """Read the "peak_apex_int" block of the raw pivot table.
+
+        Rows are grouped by species, in order of first appearance.
+
+        Args:
+            raw: The raw pivot table, as read from "PivotTable_freqs 1.csv".
+        """
+        peaks = raw.filter(pl.col("meta_value") == "peak_apex_int")
+        order, segments = group_segments(peaks, "component_group_name")
+        peaks = peaks[order]
+        values = peaks.drop(INDEX_COLUMNS)
+        ids = pl.Series("measurement_id", values.columns)
+        parsed = ids.str.extract_groups(MEASUREMENT_ID_RE).struct.unnest()
+        if parsed.null_count().sum_horizontal().item() > 0:
+            msg = (
+                "Every measurement column must be named like "
+                f"{MEASUREMENT_ID_RE!r}."
+            )
+            raise ValueError(msg)
+        return cls(
+            raw_fraction=values.to_numpy().astype(np.float64),
+            isotopologue=peaks["component_name"].alias("isotopologue"),
+            species=peaks["component_group_name"].alias("species"),
+            segments=segments,
+            measurement_id=ids,
+            sample_id=parsed[:, 0].cast(pl.Int64).to_numpy(),
+            replicate_id=parsed[:, 1].cast(pl.Int64).to_numpy(),
+        )
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.raw_fraction.shape
+
+    @property
+    def fraction(self) -> NDArray[np.float64]:
+        """Closed fractions, with the same shape as `raw_fraction`."""
+        return close(self.raw_fraction.T, self.segments).T
+
+    @property
+    def is_c12(self) -> NDArray[np.bool_]:
+        """Whether each column is a C12 control."""
+        return self.sample_id == 0
+
+    def simulate(
+        self,
+        transformations: tuple[str, ...] = ("alr", "clr", "ilr"),
+        error_sds: tuple[float, ...] = (SIM_ERROR_SD,),
+        seed: Seed = None,
+        max_workers: int | None = 1,
+    ) -> dict[tuple[str, float], NDArray[np.float64]]:
+        """Simulate every composition of the matrix.
+
+        The columns are simulated one after another, so the groups are in
+        the same order as in `prepare_data_sergi`'s long table and a seeded
+        simulation gives the same values as `simulate_sweep_arrays` on it.
+
+        Args:
+            transformations: names of the transformations to use.
+            error_sds: The standard deviations of the error.
+            seed: Seed for the simulation; see `simulate_sweep_arrays`.
+            max_workers: Number of worker processes; see
+                `simulate_sweep_arrays`.
+
+        Returns:
+            A dictionary mapping (transformation, error_sd) to an array of
+            simulated fractions with the same shape as `raw_fraction`.
+        """
+        n_rows, n_columns = self.shape
+        segments = Segments.from_lengths(
+            np.tile(self.segments.lengths, n_columns)
+        )
+        sims = simulate_sweep_sorted(
+            self.fraction.T.ravel(),
+            segments,
+            transformations,
+            error_sds,
+            seed,
+            max_workers,
+        )
+        return {
+            key: sim.reshape(n_columns, n_rows).T for key, sim in sims.items()
+        }
+
+    def to_long(self, seed: Seed = None) -> pl.DataFrame:
+        """Unpivot the matrix into the table of `prepare_data_sergi`.
+
+        Args:
+            seed: Seed for the simulated fractions.
+
+        Returns:
+            The same table as `prepare_data_sergi`, with rows in the same order
+            if each species' rows are contiguous in the raw pivot table.
+        """
+        n_rows, n_columns = self.shape
+        row = np.tile(np.arange(n_rows), n_columns)
+        column = np.repeat(np.arange(n_columns), n_rows)
+        sims = self.simulate(seed=seed)
+        return pl.DataFrame(
+            [
+                self.isotopologue.cast(pl.Categorical).gather(row),
+                self.species.cast(pl.Categorical).gather(row),
+                self.measurement_id.cast(pl.Categorical).gather(column),
+                pl.Series("raw_fraction", self.raw_fraction.T.ravel()),
+                pl.Series(
+                    "sample_id", self.sample_id[column], dtype=SAMPLE_ID_DTYPE
+                ),
+                pl.Series(
+                    "replicate_id",
+                    self.replicate_id[column],
+                    dtype=REPLICATE_ID_DTYPE,
+                ),
+                pl.Series("fraction", self.fraction.T.ravel()),
+                pl.Series("is_c12", self.is_c12[column]),
+                *(
+                    pl.Series(f"sim_fraction_{t}", sim.T.ravel())
+                    for (t, _), sim in sims.items()
+                ),
+            ]
+        )
+
+
+def prepare_matrix_sergi(raw: pl.DataFrame, seed: Seed = None) -> pl.DataFrame:
+    """Prepare Sergi's data through `SergiMatrix`.
+
+    A drop-in alternative to `prepare_data_sergi` that does not unpivot
+    before closing and simulating.
+    """
+    return SergiMatrix.from_raw(raw).to_long(seed=seed)
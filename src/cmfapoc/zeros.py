@@ -0,0 +1,133 @@
+"""Code for replacing zero and missing parts of compositions.
+
+Log-ratio transformations are undefined for zero parts, and Daria's prepared
+data has a null measurement wherever an isotopologue was not detected (e.g.
+m3 of fdp in some samples). Two replacements are offered, both as polars
+expressions over the whole table:
+
+- `impute_detection_limit` replaces missing values with a fraction of a
+  detection limit, by default the smallest value measured for the same
+  metabolite (see `detection_limit`).
+- `multiplicative_replacement` closes each composition and replaces its zeros
+  with a small value, shrinking the other parts so that their ratios are
+  unchanged.
+
+`impute_data_daria` applies either method to a prepared Daria table, so that
+every composition can go through the log-ratio transformations without
+filtering.
+
+"""
+
+from collections.abc import Sequence
+from typing import Literal
+
+import polars as pl
+from polars._typing import IntoExpr
+
+from cmfapoc.data_preparation import close
+
+DETECTION_LIMIT_FRACTION = 0.65
+
+
+def detection_limit(
+    expr: pl.Expr,
+    over: IntoExpr | Sequence[IntoExpr],
+) -> pl.Expr:
+    """Smallest positive value over the given columns.
+
+    Args:
+        expr: Measured values, with nulls or zeros where nothing was detected.
+        over: Columns sharing a detection limit, e.g. "metabolite".
+    """
+    return expr.filter(expr > 0).min().over(over)
+
+
+def impute_detection_limit(
+    expr: pl.Expr,
+    limit: pl.Expr | float,
+    fraction: float = DETECTION_LIMIT_FRACTION,
+) -> pl.Expr:
+    """Replace null and zero values with a fraction of the detection limit.
+
+    Args:
+        expr: Measured values.
+        limit: Detection limit, e.g. `detection_limit(expr, "metabolite")`.
+        fraction: Fraction of the detection limit to impute.
+    """
+    is_missing = expr.is_null() | (expr <= 0)
+    return pl.when(is_missing).then(limit * fraction).otherwise(expr)
+
+
+def multiplicative_replacement(
+    expr: pl.Expr,
+    over: IntoExpr | Sequence[IntoExpr],
+    delta: pl.Expr | float | None = None,
+) -> pl.Expr:
+    """Close each composition and replace its zero and null parts.
+
+    This is the polars version of `cmfapoc.ragged.multiplicative_replacement`.
+
+    Args:
+        expr: Non-negative parts.
+        over: Columns identifying each composition.
+        delta: Replacement value, or None for 1 / n**2 for a composition with
+            n parts.
+
+    Returns:
+        An expression with the closed, zero-free composition, or null for
+        every part of a composition with no positive parts.
+    """
+    x = close(expr.fill_null(0.0), over=over)
+    is_zero = x == 0
+    if delta is None:
+        delta = 1.0 / expr.len().over(over).cast(pl.Float64) ** 2
+    n_zeros = is_zero.sum().over(over)
+    return (
+        pl.when(x.is_nan())
+        .then(None)
+        .when(is_zero)
+        .then(delta)
+        .otherwise(x * (1 - n_zeros * delta))
+    )
+
+
+def impute_data_daria(
+    df: pl.DataFrame | pl.LazyFrame,
+    method: Literal["detection_limit", "multiplicative"] = "detection_limit",
+    fraction: float = DETECTION_LIMIT_FRACTION,
+) -> pl.DataFrame | pl.LazyFrame:
+    """Replace missing measurements in Daria's prepared data.
+
+    Args:
+        df: Output of `prepare_data_daria`, eager or lazy.
+        method: With "detection_limit", missing measurements become
+            `fraction` times the smallest measurement of the same metabolite
+            in any sample, and "measured_fraction" is recomputed. With
+            "multiplicative", "measured_fraction" is replaced by
+            `multiplicative_replacement` and "measurement" is left as is.
+            Either way, compositions with no measured part stay null.
+        fraction: Fraction of the detection limit to impute.
+
+    Returns:
+        The same table with the replaced columns and a boolean column
+        "imputed" marking the missing rows that were replaced.
+    """
+    by = ["sample", "metabolite"]
+    measurement = pl.col("measurement")
+    detected = (measurement > 0).sum().over(by) > 0
+    flagged = df.with_columns(
+        imputed=(measurement.is_null() | (measurement <= 0)) & detected
+    )
+    if method == "detection_limit":
+        limit = detection_limit(measurement, "metabolite")
+        return flagged.with_columns(
+            measurement=pl.when(detected)
+            .then(impute_detection_limit(measurement, limit, fraction))
+            .otherwise(measurement)
+        ).with_columns(measured_fraction=close(measurement, over=by))
+    if method == "multiplicative":
+        return flagged.with_columns(
+            measured_fraction=multiplicative_replacement(measurement, by)
+        )
+    msg = f"Unknown imputation method {method!r}."
+    raise ValueError(msg)
@@ -0,0 +1,37 @@
+"""Tests for cmfapoc.data_preparation."""
+
+import shutil
+from pathlib import Path
+
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from cmfapoc.data_preparation import (
+    RAW_DIR,
+    scan_data_daria,
+    update_data_daria,
+)
+
+RAW_FILES = [
+    RAW_DIR / "250218_Fluxomics_split1_900uL_g3p_excluded.csv",
+    RAW_DIR / "250218_Fluxomics_split2_900uL.csv",
+]
+NATURAL_FILE = RAW_DIR / "theoretical.csv"
+
+
+def _sorted(df: pl.DataFrame) -> pl.DataFrame:
+    df = df.with_columns(pl.col(pl.Categorical).cast(pl.String))
+    return df.sort("sample", "metabolite", "isotopologue")
+
+
+def test_update_data_daria_same_file_names(tmp_path: Path):
+    """Raw files with the same name in different directories are all used."""
+    raw_files = []
+    for raw_file, directory in zip(RAW_FILES, ["a", "b"], strict=True):
+        (tmp_path / directory).mkdir()
+        raw_files.append(tmp_path / directory / "export.csv")
+        shutil.copy(raw_file, raw_files[-1])
+    expected = scan_data_daria(RAW_FILES, NATURAL_FILE).collect()
+    for _ in range(2):  # from scratch, then from the partitions
+        got = update_data_daria(raw_files, NATURAL_FILE, tmp_path / "state")
+        assert_frame_equal(_sorted(got), _sorted(expected))